@@ -1,13 +1,25 @@
+import base64
+import difflib
 import glob
+import hashlib
 import html
+import json
 import json5
+import mmap
 import os
+import pickle
 import re
+import shlex
 import shutil
+import struct
 import subprocess
-import xml.etree.ElementTree as ET
+from array import array
+from collections import defaultdict
 from pathlib import Path
 
+def hash(s):
+	return base64.b64encode(hashlib.sha1(s.encode('UTF-8')).digest(), b'xx').decode('UTF-8').rstrip('=')
+
 def timeout():
 	timeout = shutil.which('timeout')
 	if not timeout:
@@ -53,6 +65,7 @@ def load_config(root='.'):
 		'git': True,
 		'desc': '',
 		'grep': '',
+		'dedup': False,
 	}
 	if 'defaults' not in config:
 		config['defaults'] = defaults
@@ -132,58 +145,362 @@ def resolve_steps(config, test):
 
 	return config['pipes'][test['pipe']], all_steps
 
-def load_output(fname):
+def step_fingerprints(steps, env=[]):
+	# Bump this when the way runner.py builds the pipe changes, to invalidate existing caches
+	fp = 'regtest-pipe-1\n'
+	for e in env:
+		fp += f'env\t{e}\n'
+
 	rv = {}
+	for p,s in steps.items():
+		fp += f'step\t{p}\t{s["type"]}\t{s["cmd"]}\t{s.get("trace", "")}\n'
+
+		try:
+			toks = shlex.split(s['cmd'])
+		except ValueError:
+			toks = s['cmd'].split()
+		if s['type'] == 'cg':
+			toks += ['vislcg3', 'cg-sort', 'cg-untrace']
+
+		# Any token that looks like an existing file (also after --opt=) is part of the fingerprint, as is any binary found in PATH
+		for t in toks:
+			fs = [t]
+			if '=' in t:
+				fs.append(t.split('=', 1)[1])
+			if '/' not in t and (w := shutil.which(t)):
+				fs.append(w)
+			for f in fs:
+				if os.path.isfile(f):
+					st = os.stat(f)
+					fp += f'file\t{f}\t{st.st_size}\t{st.st_mtime_ns}\n'
+
+		# Each step's fingerprint covers all the steps before it
+		rv[p] = hash(fp)
+
+	return rv
+
+def read_segments(fname):
+	# Yields (id, block) for each complete <s id="...">...</s> block in a runner output file
 	with open(fname, 'r', encoding='UTF-8') as fd:
 		while l := fd.readline():
-			if (m := re.match(r'^<s([a-zA-Z0-9]+)-\d+>\n', l)) or l.startswith('<s id="'):
-				seg = ''
-				while e := fd.readline():
-					if e.startswith('</s>'):
-						break
-					seg += e
-
-				seg = re.sub(r'[ \t]+\n', '\n', seg)
-				seg = re.sub(r'\n\n\n+', '\n\n', seg)
-				seg = seg.strip()
-
-				if m:
-					h = m[1]
-					rv[h] = {'t': seg, 'a': {}}
+			if not l.startswith('<s '):
+				continue
+			done = False
+			while e := fd.readline():
+				l += e
+				if e.startswith('</s>'):
+					done = True
+					break
+			if not done:
+				continue
+			if m := re.match(r'<s id="([^"]+)"', l):
+				yield m[1], l
+
+def index_path(root, tkey, fname):
+	# Indexes live in the output folder, so they never show up next to the git-managed expected files
+	rel = os.path.relpath(fname, root)
+	if rel.startswith(f'output/{tkey}/'):
+		rel = rel[len(f'output/{tkey}/'):]
+	return f'{root}/output/{tkey}/_index/{rel}.idx'
+
+IDX_HEAD = struct.Struct('<8sQQQQ')
+IDX_MAGIC = b'RTIDX03\n'
+
+class Index:
+	# Fixed-width (id, start, end, digest) records sorted by id, binary searched in place so a corpus' offsets are never all held in memory
+	def __init__(self, buf):
+		self.buf = buf
+		_, self.size, self.mtime, self.n, self.width = IDX_HEAD.unpack_from(buf)
+		self.rec = struct.Struct(f'<{self.width}sQQ27s')
+
+	def key(self, i):
+		o = IDX_HEAD.size + i*self.rec.size
+		return self.buf[o:o+self.width]
+
+	def get(self, id):
+		k = id.encode('UTF-8')
+		if len(k) > self.width:
+			return None
+		k = k.ljust(self.width, b'\0')
+		lo, hi = 0, self.n
+		while lo < hi:
+			mid = (lo+hi) // 2
+			if self.key(mid) < k:
+				lo = mid+1
+			else:
+				hi = mid
+		if lo < self.n and self.key(lo) == k:
+			_, a, b, _ = self.rec.unpack_from(self.buf, IDX_HEAD.size + lo*self.rec.size)
+			return a, b
+		return None
+
+	def items(self):
+		# Yields (id, start, end, digest) in id order
+		for k, a, b, d in self.rec.iter_unpack(self.buf[IDX_HEAD.size:IDX_HEAD.size + self.n*self.rec.size]):
+			yield k.rstrip(b'\0').decode('UTF-8'), a, b, d.rstrip(b'\0').decode('UTF-8')
+
+	def __contains__(self, id):
+		return self.get(id) is not None
+
+	def __len__(self):
+		return self.n
+
+	def __iter__(self):
+		for i in range(self.n):
+			yield self.key(i).rstrip(b'\0').decode('UTF-8')
+
+def build_index(fname, idx=None):
+	st = os.stat(fname)
+	rv = {}
+	for id,_,body,a,b in scan_segments(fname):
+		# The digest is of the normalized text, same as digest(load_output(fname)[id]['t'])
+		rv[id.encode('UTF-8')] = (a, b, digest(norm_text(body)).encode('UTF-8'))
+
+	width = max((len(k) for k in rv), default=1)
+	rec = struct.Struct(f'<{width}sQQ27s')
+	buf = IDX_HEAD.pack(IDX_MAGIC, st.st_size, st.st_mtime_ns, len(rv), width)
+	buf += b''.join(rec.pack(k, *v) for k,v in sorted((k.ljust(width, b'\0'), v) for k,v in rv.items()))
+
+	if idx:
+		try:
+			os.makedirs(os.path.dirname(idx), exist_ok=True)
+			Path(f'{idx}.new').write_bytes(buf)
+			os.replace(f'{idx}.new', idx)
+		except OSError:
+			pass
+	return Index(buf)
+
+def load_index(fname, idx):
+	# The index is only trusted if the file it describes hasn't changed since
+	st = os.stat(fname)
+	try:
+		with open(idx, 'rb') as fd:
+			head = fd.read(IDX_HEAD.size)
+			if len(head) == IDX_HEAD.size and IDX_HEAD.unpack(head)[0:3] == (IDX_MAGIC, st.st_size, st.st_mtime_ns):
+				return Index(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+	except FileNotFoundError:
+		pass
+	return build_index(fname, idx)
+
+def parse_segment(block):
+	m = RE_HEAD.match(block)
+	end = block.find(b'\n</s>', m.end()-1)
+	body = block[m.end():end+1] if end >= 0 else block[m.end():]
+	return (m[1] or m[2]).decode('UTF-8'), {'t': norm_text(body), 'a': parse_attrs(m[3])}
+
+def read_segment(fd, index, id):
+	if not (r := index.get(id)):
+		return None
+	fd.seek(r[0])
+	return parse_segment(fd.read(r[1] - r[0]))[1]
+
+def load_segments(fname, index, ids):
+	# Reads just the given segments, in file order to keep the seeks short
+	rv = {}
+	rs = sorted((r, id) for id in ids if (r := index.get(id)))
+	with open(fname, 'rb') as fd:
+		for (a, b), id in rs:
+			fd.seek(a)
+			_, rv[id] = parse_segment(fd.read(b - a))
+	return rv
+
+def fetch_segments(root, tkey, fname, ids):
+	if not ids or not os.path.exists(fname):
+		return {}
+	return load_segments(fname, load_index(fname, index_path(root, tkey, fname)), ids)
+
+def digest(t):
+	# Empty texts keep an empty digest, so "not e['o'][i]" still means no output
+	if not t:
+		return ''
+	return hash(t)
+
+def diff_tokens(t, lines):
+	if lines:
+		return re.findall(r'[^\n]*\n|[^\n]+', t)
+	# Same split as jsdiff's diffWordsWithSpace()
+	return [w for w in re.split(r'(\s+|[()[\]{}\'"]|\b)', t) if w]
+
+def diff_texts(o, e, line_mode):
+	# [op, text] pairs, op being '=', '-' (only in expected) or '+' (only in output).
+	# Like the UI, whether to diff by line is decided from the expected text, and both sides are split the same way.
+	lines = e.count('\n') >= line_mode
+	a = diff_tokens(e, lines)
+	b = diff_tokens(o, lines)
+	rv = []
+	def add(op, ts):
+		if not ts:
+			return
+		if rv and rv[-1][0] == op:
+			rv[-1][1] += ''.join(ts)
+		else:
+			rv.append([op, ''.join(ts)])
+	for op,a1,a2,b1,b2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+		if op == 'equal':
+			add('=', a[a1:a2])
+		else:
+			add('-', a[a1:a2])
+			add('+', b[b1:b2])
+	return rv
+
+RE_HEAD = re.compile(rb'<s([a-zA-Z0-9]+)-\d+>\n|<s id="([^"]+)"([^\n]*)\n?')
+RE_ATTR = re.compile(rb'''([^\s=<>/"']+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+RE_BLANK_LINES = re.compile(rb'\n\n\n+')
+
+def scan_segments(fname):
+	# Yields (id, header attributes, raw text, start, end) per segment, using only substring searches over an mmap.
+	# A segment starts at a line "<sID-N>" or "<s id=...", and runs until the first line starting with "</s>" or the end of the file.
+	with open(fname, 'rb') as fd:
+		if not os.fstat(fd.fileno()).st_size:
+			return
+		with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			p = 0
+			while p >= 0:
+				if not (m := RE_HEAD.match(mm, p)):
+					if (p := mm.find(b'\n<s', p)) >= 0:
+						p += 1
+					continue
+				end = mm.find(b'\n</s>', m.end()-1)
+				if end < 0:
+					yield (m[1] or m[2]).decode('UTF-8'), m[3], mm[m.end():], p, len(mm)
+					break
+				body = mm[m.end():end+1]
+				if (q := mm.find(b'\n', end+1)) >= 0:
+					yield (m[1] or m[2]).decode('UTF-8'), m[3], body, p, q+1
+					p = q+1
 				else:
-					h = re.search(r' id="([^"]+)"', l)[1]
-					l = re.sub(r' id="([^"]+)"', '', l)
-					tag = ET.fromstring(l+'</s>')
-					rv[h] = {'t': seg, 'a': tag.attrib}
+					yield (m[1] or m[2]).decode('UTF-8'), m[3], body, p, len(mm)
+					break
+
+def norm_text(b):
+	# Substring checks first, as most segments need neither substitution
+	if b' \n' in b or b'\t\n' in b:
+		b = b'\n'.join(l.rstrip(b' \t') for l in b.split(b'\n'))
+	if b'\n\n\n' in b:
+		b = RE_BLANK_LINES.sub(b'\n\n', b)
+	return b.decode('UTF-8').strip()
+
+def parse_attrs(b):
+	# Same result as ElementTree would give for the header, without building a tree per segment
+	if not b:
+		return {}
+	return {k.decode('UTF-8'): html.unescape((v1 + v2).decode('UTF-8')).replace('\t', ' ') for k,v1,v2 in RE_ATTR.findall(b)}
+
+RE_TERM = re.compile(r'\w+')
+
+def terms_path(root, tkey, fname):
+	return index_path(root, tkey, fname)[:-4] + '.terms'
+
+def build_terms(fname, path=None):
+	# Inverted index from each lowercased word to the ordinals of the segments it occurs in
+	st = os.stat(fname)
+	ids = []
+	terms = defaultdict(lambda: array('I'))
+	for id,_,body,_,_ in scan_segments(fname):
+		for w in set(RE_TERM.findall(body.decode('UTF-8', 'replace').lower())):
+			terms[w].append(len(ids))
+		ids.append(id)
+	rv = {'stat': (st.st_size, st.st_mtime_ns), 'ids': ids, 'terms': dict(terms)}
+
+	if path:
+		try:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(f'{path}.new', 'wb') as fd:
+				pickle.dump(rv, fd, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(f'{path}.new', path)
+		except OSError:
+			pass
+	return rv
+
+def load_terms(fname, path):
+	st = os.stat(fname)
+	try:
+		with open(path, 'rb') as fd:
+			rv = pickle.load(fd)
+		if rv['stat'] == (st.st_size, st.st_mtime_ns):
+			return rv
+	except Exception:
+		pass
+	return build_terms(fname, path)
+
+def match_terms(terms, words):
+	# Ordinals of the segments that have all of the words, or None if there are no words to go by.
+	# A word may be the middle of a longer term, so every term containing it counts.
+	rv = None
+	for q in words:
+		q = q.lower()
+		ns = set()
+		for w,p in terms['terms'].items():
+			if q in w:
+				ns.update(p)
+		rv = ns if rv is None else rv & ns
+		if not rv:
+			break
+	return rv
+
+def regex_words(rx):
+	# Words that any match of the regex must contain, taken from the literal runs outside groups; alternations or inline flags give none, so everything gets searched
+	if '|' in rx or rx.startswith('(?'):
+		return []
+	runs = []
+	cur = ''
+	depth = 0
+	i = 0
+	while i < len(rx):
+		ch = rx[i]
+		if ch == '\\':
+			runs.append(cur)
+			cur = ''
+			i += 2
+			continue
+		if ch == '[':
+			runs.append(cur)
+			cur = ''
+			i += 2 if rx[i+1:i+2] == '^' else 1
+			i = rx.find(']', i+1)
+			if i < 0:
+				break
+		elif ch in '?*{':
+			# The char before is optional or repeated, and a {m,n} body is no literal text either
+			runs.append(cur[:-1])
+			cur = ''
+			if ch == '{':
+				i = rx.find('}', i)
+				if i < 0:
+					break
+		elif ch in '()+.^$':
+			depth += {'(': 1, ')': -1}.get(ch, 0)
+			runs.append(cur)
+			cur = ''
+		elif depth == 0:
+			cur += ch
+		i += 1
+	runs.append(cur)
+
+	rv = []
+	for r in runs:
+		rv += RE_TERM.findall(r)
 	return rv
 
+def iter_output(fname):
+	for id,attrs,body,_,_ in scan_segments(fname):
+		yield id, {'t': norm_text(body), 'a': parse_attrs(attrs)}
+
+def load_output(fname):
+	return dict(iter_output(fname))
+
 def load_gold(fname):
 	rv = {}
-	with open(fname, 'r', encoding='UTF-8') as fd:
-		while l := fd.readline():
-			if (m := re.match(r'^<s([a-zA-Z0-9]+)-\d+>\n', l)) or l.startswith('<s id="'):
-				seg = ''
-				while e := fd.readline():
-					if e.startswith('</s>'):
-						break
-					seg += e
-
-				h = ''
-				if m:
-					h = m[1]
-				else:
-					h = re.search(r' id="([^"]+)"', l)[1]
-
-				rv[h] = set()
-				seg = re.sub(r'(^|\n)<gold>(\n|$)', '\n', seg)
-				seg = seg.split('\n</gold>')
-				for s in seg:
-					s = re.sub(r'[ \t]+\n', '\n', s)
-					s = re.sub(r'\n\n\n+', '\n\n', s)
-					s = s.strip()
-					if s:
-						rv[h].add(s)
-				rv[h] = sorted(list(rv[h]))
+	for h,_,body,_,_ in scan_segments(fname):
+		seg = re.sub(r'(^|\n)<gold>(\n|$)', '\n', body.decode('UTF-8'))
+		gs = set()
+		for s in seg.split('\n</gold>'):
+			s = re.sub(r'[ \t]+\n', '\n', s)
+			s = re.sub(r'\n\n\n+', '\n\n', s)
+			s = s.strip()
+			if s:
+				gs.add(s)
+		rv[h] = sorted(gs)
 	return rv
 
 def save_expected(root, test, c, state):
@@ -193,6 +510,10 @@ def save_expected(root, test, c, state):
 		for k,v in state[s].items():
 			if c in v['c'] and v['c'][c] != 0:
 				data[k] = v
+	# Inputs that timed out keep what was expected of them, for when they get through again
+	for k,v in state.get('timedout', {}).items():
+		if c in v['c'] and v['e'][0]:
+			data[k] = v
 
 	local = ''
 	if '/local/' in test['all_corpora'][c]:
@@ -201,42 +522,145 @@ def save_expected(root, test, c, state):
 	data = dict(sorted(data.items()))
 	os.makedirs(f'{root}{local}/expected/{tkey}/{c}/', exist_ok=True)
 
+	if test['dedup']:
+		save_store(root, test, c, data)
+		return
+
 	for i,k in enumerate(test['all_steps']):
 		if k.endswith('-trace'):
 			continue
-		out = ''
-		for id,v in data.items():
-			t = v['e'][i]
-			a = ''
-			for ak,av in v['a'].items():
-				av = html.escape(av, quote=True)
-				a += f' {ak}="{av}"'
-			out += f'<s id="{id}"{a}>\n{t}\n</s>\n\n'
 		fn = f'{root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt'
-		Path(fn).write_text(out)
+		ofn = f'{root}/output/{tkey}/{c}/output-{c}-{k}.txt'
 
-def save_gold(root, test, c, state):
-	tkey = test['test']
-	data = {}
-	for s in ['changed_final', 'changed_any', 'golden', 'unchanged']:
-		for k,v in state[s].items():
-			if not v['g']:
-				continue
-			if c in v['c']:
-				data[k] = v
+		# State only holds digests, so each text is read back from whichever of output or expected has that version
+		srcs = {}
+		for f in [ofn, fn]:
+			if os.path.exists(f):
+				srcs[f] = (open(f, 'rb'), load_index(f, index_path(root, tkey, f)))
+
+		with open(f'{fn}.new', 'w', encoding='UTF-8') as out:
+			for id,v in data.items():
+				t = ''
+				if v['e'][i]:
+					f = ofn if v['e'][i] == v['o'][i] else fn
+					if f in srcs and (seg := read_segment(*srcs[f], id)):
+						t = seg['t']
+				out.write(f'<s id="{id}"{fmt_attrs(v["a"])}>\n{t}\n</s>\n\n')
 
+		for fd,_ in srcs.values():
+			fd.close()
+		os.replace(f'{fn}.new', fn)
+		build_index(fn, index_path(root, tkey, fn))
+
+def fmt_attrs(attrs):
+	a = ''
+	for ak,av in attrs.items():
+		av = html.escape(av, quote=True)
+		a += f' {ak}="{av}"'
+	return a
+
+def store_paths(root, test, c):
+	# The deduplicated store is one blobs file per test holding each distinct text once, keyed by digest, plus a manifest of digests per corpus
+	tkey = test['test']
 	local = ''
 	if '/local/' in test['all_corpora'][c]:
 		local = '/local'
+	return f'{root}{local}/expected/{tkey}/blobs.txt', f'{root}{local}/expected/{tkey}/{c}/expected-{c}.manifest'
 
-	data = dict(sorted(data.items()))
-	os.makedirs(f'{root}{local}/expected/{tkey}/{c}/', exist_ok=True)
+def load_manifest(fname):
+	rv = {}
+	with open(fname, 'r', encoding='UTF-8') as fd:
+		steps = fd.readline().rstrip('\n').split('\t')[1:]
+		for l in fd:
+			l = l.rstrip('\n').split('\t')
+			rv[l[0]] = {'a': json.loads(l[1]), 'e': dict(zip(steps, l[2:]))}
+	return rv
 
-	out = ''
+def save_store(root, test, c, data):
+	tkey = test['test']
+	blobs, man = store_paths(root, test, c)
+	edir = os.path.dirname(os.path.dirname(blobs))
+	steps = [(i,k) for i,k in enumerate(test['all_steps']) if not k.endswith('-trace')]
+	index = {}
+	if os.path.exists(blobs):
+		index = load_index(blobs, index_path(root, tkey, blobs))
+
+	# Texts not yet in the store are either accepted outputs, or come from the plain expected files this corpus had before switching to the store
+	want = defaultdict(list)
+	seen = set()
 	for id,v in data.items():
-		t = '\n</gold>\n<gold>\n'.join(v['g'])
+		for i,k in steps:
+			d = v['e'][i]
+			if not d or d in seen or d in index:
+				continue
+			seen.add(d)
+			f = f'{edir}/{tkey}/{c}/expected-{c}-{k}.txt'
+			if d == v['o'][i]:
+				f = f'{root}/output/{tkey}/{c}/output-{c}-{k}.txt'
+			want[f].append((id, d))
+
+	with open(blobs, 'a', encoding='UTF-8') as out:
+		for f,ls in want.items():
+			segs = fetch_segments(root, tkey, f, [id for id,_ in ls])
+			for id,d in ls:
+				if id in segs:
+					out.write(f'<s id="{d}">\n{segs[id]["t"]}\n</s>\n\n')
+
+	out = '#regtest-manifest\t' + '\t'.join(k for _,k in steps) + '\n'
+	for id,v in data.items():
+		out += f'{id}\t{json.dumps(v["a"], ensure_ascii=False)}\t' + '\t'.join(v['e'][i] for i,_ in steps) + '\n'
+	Path(f'{man}.new').write_text(out, encoding='UTF-8')
+	os.replace(f'{man}.new', man)
+
+	compact_store(root, tkey, blobs)
+
+def compact_store(root, tkey, blobs):
+	# Blobs no longer referenced by any manifest are only dropped once they make up half the store, to not rewrite it on every accept
+	refs = set()
+	for fn in glob.glob(f'{os.path.dirname(blobs)}/*/expected-*.manifest'):
+		for e in load_manifest(fn).values():
+			refs |= set(e['e'].values())
+
+	index = load_index(blobs, index_path(root, tkey, blobs))
+	if len(index) < 2*len(refs):
+		return
+
+	with open(blobs, 'rb') as src, open(f'{blobs}.new', 'wb') as dst:
+		for d,a,b,_ in index.items():
+			if d in refs:
+				src.seek(a)
+				dst.write(src.read(b - a) + b'\n')
+	os.replace(f'{blobs}.new', blobs)
+	build_index(blobs, index_path(root, tkey, blobs))
+
+def export_expected(root, test, c):
+	# Writes the plain expected-{c}-{step}.txt files back out from the store, e.g. for reviewing or when switching dedup off again
+	tkey = test['test']
+	blobs, man = store_paths(root, test, c)
+	edir = os.path.dirname(os.path.dirname(blobs))
+	ents = dict(sorted(load_manifest(man).items()))
+	index = load_index(blobs, index_path(root, tkey, blobs))
+
+	with open(blobs, 'rb') as bfd:
+		for k in test['all_steps']:
+			if k.endswith('-trace'):
+				continue
+			fn = f'{edir}/{tkey}/{c}/expected-{c}-{k}.txt'
+			with open(fn, 'w', encoding='UTF-8') as out:
+				for id,e in ents.items():
+					t = ''
+					if (d := e['e'].get(k)) and (seg := read_segment(bfd, index, d)):
+						t = seg['t']
+					out.write(f'<s id="{id}"{fmt_attrs(e["a"])}>\n{t}\n</s>\n\n')
+			build_index(fn, index_path(root, tkey, fn))
+
+def write_gold(fn, golds):
+	out = ''
+	for id,g in sorted(golds.items()):
+		if not g:
+			continue
+		t = '\n</gold>\n<gold>\n'.join(g)
 		out += f'<s id="{id}">\n<gold>\n{t}\n</gold>\n</s>\n\n'
-	fn = f'{root}{local}/expected/{tkey}/{c}/gold-{c}.txt'
 
 	if out:
 		Path(fn).write_text(out)
@@ -245,3 +669,77 @@ def save_gold(root, test, c, state):
 			os.remove(fn)
 		except Exception as e:
 			pass
+
+def journal_path(root, tkey, c):
+	return f'{root}/output/{tkey}/_journal/{c}.jsonl'
+
+def journal_append(root, tkey, c, recs):
+	# Records are {id, s: step, a: attributes, t: text}, {id, del: 1} to drop an id, or {id, g: golds}
+	fn = journal_path(root, tkey, c)
+	os.makedirs(os.path.dirname(fn), exist_ok=True)
+	with open(fn, 'a', encoding='UTF-8') as fd:
+		for r in recs:
+			fd.write(json.dumps(r, ensure_ascii=False) + '\n')
+		fd.flush()
+		os.fsync(fd.fileno())
+
+def compact_journal(root, test, c):
+	# Records carry whole values, so replaying a journal again after an interrupted compaction gives the same files
+	tkey = test['test']
+	jfn = journal_path(root, tkey, c)
+	if not os.path.exists(jfn):
+		return False
+
+	steps = [k for k in test['all_steps'] if not k.endswith('-trace')]
+	texts = defaultdict(dict)
+	golds = {}
+	with open(jfn, 'r', encoding='UTF-8') as fd:
+		for l in fd:
+			try:
+				r = json.loads(l)
+			except ValueError:
+				# Torn write at the end of a journal from a crash
+				continue
+			if 'del' in r:
+				for k in steps:
+					texts[k][r['id']] = None
+			elif 'g' in r:
+				golds[r['id']] = r['g']
+			else:
+				texts[r['s']][r['id']] = (r['a'], r['t'])
+
+	local = ''
+	if '/local/' in test['all_corpora'][c]:
+		local = '/local'
+	os.makedirs(f'{root}{local}/expected/{tkey}/{c}/', exist_ok=True)
+
+	# Every step is rewritten, so files a run copied from the unsorted output end up sorted too
+	for k in (steps if texts else []):
+		fn = f'{root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt'
+		ch = texts.get(k, {})
+		index = {}
+		if os.path.exists(fn):
+			index = load_index(fn, index_path(root, tkey, fn))
+		with open(fn if index else os.devnull, 'rb') as src, open(f'{fn}.new', 'w', encoding='UTF-8') as out:
+			for id in sorted(set(index) | set(ch)):
+				if id in ch:
+					if ch[id] is None:
+						continue
+					a, t = ch[id]
+				else:
+					seg = read_segment(src, index, id)
+					a, t = seg['a'], seg['t']
+				out.write(f'<s id="{id}"{fmt_attrs(a)}>\n{t}\n</s>\n\n')
+		os.replace(f'{fn}.new', fn)
+		build_index(fn, index_path(root, tkey, fn))
+
+	if golds:
+		fn = f'{root}{local}/expected/{tkey}/{c}/gold-{c}.txt'
+		gs = {}
+		if os.path.exists(fn):
+			gs = load_gold(fn)
+		gs.update(golds)
+		write_gold(fn, gs)
+
+	os.remove(jfn)
+	return True
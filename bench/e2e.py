@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+import zlib
+from pathlib import Path
+
+g_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, g_dir)
+import Helpers
+
+parser = argparse.ArgumentParser(prog='bench/e2e.py', description='Times regtest itself, end to end, on a generated project whose pipeline steps are cheap stand-ins for the real tools.')
+parser.add_argument('-k', '--corpora', action='store', help='Number of corpora; defaults to 3', default=3)
+parser.add_argument('-n', '--sentences', action='store', help='Sentences per corpus; defaults to 2000', default=2000)
+parser.add_argument('-l', '--length', action='store', help='Words per sentence; defaults to 15', default=15)
+parser.add_argument('-s', '--steps', action='store', help='Number of filter steps after the analysis step; defaults to 3', default=3)
+parser.add_argument('-t', '--trace', action='store', help='Trace tags per reading added by the fake CG step; 0 leaves the CG step out; defaults to 4', default=4)
+parser.add_argument('-P', '--proc', action='store', help='Number of parallel processes for runner.py; defaults to its own default', default='')
+parser.add_argument('-E', '--engine', action='store', choices=['bash', 'native'], help='Engine for runner.py; defaults to bash', default='bash')
+parser.add_argument('-a', '--accepts', action='store', help='Number of single-entry accepts to time over HTTP; defaults to 20', default=20)
+parser.add_argument('-o', '--output', action='store', help='Also write the results as JSON to this file', default='')
+parser.add_argument('-K', '--keep', action='store_true', help='Keep the generated project instead of deleting it', default=False)
+args = parser.parse_args()
+
+# Stand-ins for the real tools: the analysis turns words into cohorts, the filters rewrite tags, and vislcg3/cg-sort/cg-untrace add and remove trace tags like CG does
+STANDINS = {
+	'rt-analyse': '''#!/bin/sh
+exec awk '/^</ { print; next } { for (i = 1; i <= NF; i++) printf "\\"<%s>\\"\\n\\t\\"%s\\" N Sg T%d\\n", $i, tolower($i), length($i) % 10 }'
+''',
+	'rt-filter': '''#!/bin/sh
+exec sed -e "/^</!s/$1/$2/g"
+''',
+	'vislcg3': '''#!/bin/sh
+exec sed -e "/^\\t/s/\\$/$RT_TRACE/"
+''',
+	'cg-sort': '''#!/bin/sh
+exec cat
+''',
+	'cg-untrace': '''#!/bin/sh
+exec sed -e 's/ SELECT:[0-9]*//g'
+''',
+	}
+
+def gen_project(root):
+	rnd = random.Random(42)
+	words = [''.join(rnd.choice('abcdefghijklmnopqrstuvwxyzæøå') for _ in range(rnd.randint(1, 12))) for _ in range(5000)]
+	os.makedirs(f'{root}/corpora')
+	for c in range(int(args.corpora)):
+		with open(f'{root}/corpora/c{c}.txt', 'w', encoding='UTF-8') as fd:
+			for n in range(int(args.sentences)):
+				fd.write(' '.join(rnd.choice(words) for _ in range(int(args.length))) + '\n')
+
+	os.makedirs(f'{root}/bin')
+	for k,v in STANDINS.items():
+		Path(f'{root}/bin/{k}').write_text(v)
+		os.chmod(f'{root}/bin/{k}', stat.S_IRWXU)
+
+	write_config(root, 'S')
+
+def write_config(root, last):
+	# Changing what the last filter writes makes that step differ for every reading it touches
+	steps = {'analyse': {'cmd': 'rt-analyse'}}
+	if int(args.trace):
+		steps['disamb'] = {'cmd': 'vislcg3', 'type': 'cg'}
+	for i in range(1, int(args.steps)+1):
+		steps[f'f{i}'] = {'cmd': f"rt-filter ' T{i}$' ' T{i} {last if i == int(args.steps) else 'S'}{i}'"}
+	config = {
+		'tests': {'bench': {'pipe': 'p', 'corpora': ['all'], 'git': False}},
+		'pipes': {'p': list(steps.keys())},
+		'steps': steps,
+		'corpora': {'all': ['c*']},
+		}
+	Path(f'{root}/regtest.json5').write_text(json.dumps(config, indent=1))
+
+def env():
+	rv = dict(os.environ)
+	rv['PATH'] = f'{proj}/bin:{rv["PATH"]}'
+	rv['RT_TRACE'] = ''.join(f' SELECT:{1000+i}' for i in range(int(args.trace)))
+	return rv
+
+def run_runner(label):
+	cmd = [sys.executable, f'{g_dir}/runner.py', '-f', proj, '-E', args.engine, '-T', f'{proj}/timings.json', 'bench']
+	if args.proc:
+		cmd[2:2] = ['-P', str(args.proc)]
+	t = time.perf_counter()
+	subprocess.run(cmd, env=env(), check=True, stdout=subprocess.DEVNULL)
+	t = time.perf_counter() - t
+	rv = json.loads(Path(f'{proj}/timings.json').read_text())
+	rv['total'] = t
+	results['phases'][label] = rv
+	print(f'{label:<24} {t:8.2f}s  ' + ', '.join(f'{k} {v:.2f}s' for k,v in rv.items() if k != 'total'))
+
+def timed(label, fn, *fargs, **kw):
+	t = time.perf_counter()
+	rv = fn(*fargs, **kw)
+	t = time.perf_counter() - t
+	results['phases'][label] = t
+	print(f'{label:<24} {t:8.2f}s')
+	return rv
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(('localhost', 0))
+		return s.getsockname()[1]
+
+class Server:
+	def __init__(self):
+		self.port = free_port()
+		self.log = open(f'{proj}/server.log', 'a')
+		self.proc = subprocess.Popen([sys.executable, f'{g_dir}/regtest.py', '-f', proj, '-p', str(self.port), 'bench'], env=env(), stdout=self.log, stderr=subprocess.STDOUT)
+		for _ in range(100):
+			try:
+				with socket.create_connection(('localhost', self.port), timeout=0.1):
+					break
+			except OSError:
+				time.sleep(0.1)
+		self.call(a='init-regtest', t='bench')
+
+	def call(self, **params):
+		rv = urllib.request.urlopen(f'http://localhost:{self.port}/callback', urllib.parse.urlencode(params).encode('UTF-8')).read()
+		return json.loads(zlib.decompress(rv))
+
+	def stop(self):
+		# SIGINT lets the server merge its journal before exiting
+		self.proc.send_signal(signal.SIGINT)
+		self.proc.wait()
+		self.log.close()
+
+def load_outputs():
+	n = 0
+	for c in range(int(args.corpora)):
+		for fn in Path(f'{proj}/output/bench/c{c}').glob('output-*.txt'):
+			n += len(Helpers.load_output(str(fn)))
+	return n
+
+def save_all():
+	# Accepting everything, built from the offset indexes the same way cb_load() would hold it in state
+	config = Helpers.load_config(proj)
+	_, test = Helpers.resolve_test(config, 'bench')
+	test['steps'], test['all_steps'] = Helpers.resolve_steps(config, test)
+	test['all_corpora'] = Helpers.resolve_corps(proj, config, test)
+	for c in test['all_corpora'].keys():
+		state = {'changed_final': {}, 'changed_any': {}, 'golden': {}, 'unchanged': {}}
+		for i,k in enumerate(test['all_steps']):
+			fn = f'{proj}/output/bench/{c}/output-{c}-{k}.txt'
+			for id,_,_,d in Helpers.load_index(fn, Helpers.index_path(proj, 'bench', fn)).items():
+				e = state['unchanged'].setdefault(id, {'c': {c: 1}, 'a': {}, 'o': ['']*len(test['all_steps']), 'e': ['']*len(test['all_steps'])})
+				e['o'][i] = d
+				e['e'][i] = d
+		Helpers.save_expected(proj, test, c, state)
+
+def http_phases():
+	srv = Server()
+	try:
+		timed('http_load_first', srv.call, a='load', t='bench', c='*', g='*', p=0, z=250)
+	finally:
+		srv.stop()
+
+	write_config(proj, 'X')
+	run_runner('runner_changed')
+	shutil.rmtree(f'{proj}/output/bench/_state', ignore_errors=True)
+
+	srv = Server()
+	try:
+		rv = timed('http_load_cold', srv.call, a='load', t='bench', c='*', g='*', p=0, z=250)
+		results['sizes']['changed'] = rv['counts']['changed_final'] + rv['counts']['changed_any']
+		timed('http_load_page', srv.call, a='load', t='bench', c='*', g='*', p=1, z=250, d=1)
+		timed('http_search', srv.call, a='search', t='bench', q=f'X{args.steps}', z=250)
+		hs = [e['h'] for e in rv['results']['changed_final']][:int(args.accepts)]
+		ts = []
+		for h in hs:
+			t = time.perf_counter()
+			srv.call(a='accept', t='bench', hs=h)
+			ts.append(time.perf_counter() - t)
+		if ts:
+			results['phases']['http_accept'] = sum(ts) / len(ts)
+			print(f'{"http_accept":<24} {results["phases"]["http_accept"]*1000:8.2f}ms mean of {len(ts)}')
+	finally:
+		t = time.perf_counter()
+		srv.stop()
+		results['phases']['http_stop'] = time.perf_counter() - t
+
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=g_dir, capture_output=True, encoding='UTF-8', check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return ''
+
+results = {
+	'bench': 'e2e',
+	'commit': git_commit(),
+	'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+	'python': platform.python_version(),
+	'cpus': os.cpu_count(),
+	'params': {k: v for k,v in vars(args).items() if k not in ['output', 'keep']},
+	'sizes': {},
+	'phases': {},
+	}
+
+proj = tempfile.mkdtemp(prefix='regtest-e2e-')
+print(f'Generating project in {proj}')
+try:
+	gen_project(proj)
+	run_runner('runner_first')
+	results['sizes']['output_bytes'] = sum(f.stat().st_size for f in Path(f'{proj}/output/bench').glob('c*/output-*.txt'))
+	results['sizes']['segments'] = timed('load_output', load_outputs)
+	http_phases()
+	timed('save_expected', save_all)
+finally:
+	if not args.keep:
+		shutil.rmtree(proj, ignore_errors=True)
+
+out = json.dumps(results, indent=1)
+print(out)
+if args.output:
+	Path(args.output).write_text(out + '\n', encoding='UTF-8')
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Helpers
+
+parser = argparse.ArgumentParser(prog='bench/parse.py', description='Times Helpers.load_output and load_gold against the previous line-by-line parser.')
+parser.add_argument('-s', '--size', action='store', help='Size of the generated trace file in MB; defaults to 300', default=300)
+parser.add_argument('-f', '--file', action='store', help='Parse this output file instead of generating one', default='')
+parser.add_argument('-g', '--gold', action='store', help='Parse this gold file instead of generating one', default='')
+args = parser.parse_args()
+
+# The parsers as they were before the mmap scanner, kept here as the baseline
+def readline_load_output(fname):
+	rv = {}
+	with open(fname, 'r', encoding='UTF-8') as fd:
+		while l := fd.readline():
+			if (m := re.match(r'^<s([a-zA-Z0-9]+)-\d+>\n', l)) or l.startswith('<s id="'):
+				seg = ''
+				while e := fd.readline():
+					if e.startswith('</s>'):
+						break
+					seg += e
+
+				seg = re.sub(r'[ \t]+\n', '\n', seg)
+				seg = re.sub(r'\n\n\n+', '\n\n', seg)
+				seg = seg.strip()
+
+				if m:
+					h = m[1]
+					rv[h] = {'t': seg, 'a': {}}
+				else:
+					h = re.search(r' id="([^"]+)"', l)[1]
+					l = re.sub(r' id="([^"]+)"', '', l)
+					tag = ET.fromstring(l+'</s>')
+					rv[h] = {'t': seg, 'a': tag.attrib}
+	return rv
+
+def readline_load_gold(fname):
+	rv = {}
+	with open(fname, 'r', encoding='UTF-8') as fd:
+		while l := fd.readline():
+			if (m := re.match(r'^<s([a-zA-Z0-9]+)-\d+>\n', l)) or l.startswith('<s id="'):
+				seg = ''
+				while e := fd.readline():
+					if e.startswith('</s>'):
+						break
+					seg += e
+
+				h = ''
+				if m:
+					h = m[1]
+				else:
+					h = re.search(r' id="([^"]+)"', l)[1]
+
+				rv[h] = set()
+				seg = re.sub(r'(^|\n)<gold>(\n|$)', '\n', seg)
+				seg = seg.split('\n</gold>')
+				for s in seg:
+					s = re.sub(r'[ \t]+\n', '\n', s)
+					s = re.sub(r'\n\n\n+', '\n\n', s)
+					s = s.strip()
+					if s:
+						rv[h].add(s)
+				rv[h] = sorted(list(rv[h]))
+	return rv
+
+def gen_trace(fname, size):
+	# CG-style traces: long segments of cohorts, each reading with a handful of rule traces
+	rnd = random.Random(42)
+	words = ['hus', 'bil', 'kat', 'hund', 'løbe', 'stor', 'lille', 'og', 'i', 'på', 'ikke', 'der']
+	tags = ['N', 'V', 'ADJ', 'ADV', 'PR', 'CONJ', 'Sg', 'Pl', 'Def', 'Idf', 'PRES', 'PAST', '@SUBJ', '@OBJ', '@ADVL']
+	with open(fname, 'w', encoding='UTF-8') as fd:
+		n = 0
+		while fd.tell() < size:
+			n += 1
+			out = f'<s id="{Helpers.hash(str(n))}" n="{n}" src="bench &amp; test">\n'
+			for _ in range(rnd.randint(5, 60)):
+				w = rnd.choice(words)
+				out += f'"<{w}>"\n'
+				for _ in range(rnd.randint(1, 4)):
+					out += f'\t"{w}" ' + ' '.join(rnd.sample(tags, 4)) + f' SELECT:{rnd.randint(100, 9999)} MAP:{rnd.randint(100, 9999)}\n'
+			# Some steps leave trailing whitespace and runs of blank lines, which the parser has to normalize
+			if n % 10 == 0:
+				out = out.replace('\n', ' \n')
+			out += '\n\n\n</s>\n\n'
+			fd.write(out)
+	return n
+
+def gen_gold(fname, n):
+	rnd = random.Random(43)
+	with open(fname, 'w', encoding='UTF-8') as fd:
+		for i in range(1, n+1):
+			gs = '\n</gold>\n<gold>\n'.join(f'gold {i} {j}\nline {rnd.randint(0, 99)}' for j in range(rnd.randint(1, 3)))
+			fd.write(f'<s id="{Helpers.hash(str(i))}">\n<gold>\n{gs}\n</gold>\n</s>\n\n')
+
+def timed(label, fn, fname):
+	t = time.perf_counter()
+	rv = fn(fname)
+	t = time.perf_counter() - t
+	mb = os.path.getsize(fname) / (1 << 20)
+	print(f'{label:<24} {t:8.2f}s {mb/t:8.1f} MB/s  {len(rv)} segments')
+	return rv, t
+
+tmp = tempfile.mkdtemp(prefix='regtest-bench-')
+fname = args.file
+gname = args.gold
+if not fname:
+	fname = f'{tmp}/output.txt'
+	print(f'Generating {args.size} MB trace file in {fname}')
+	n = gen_trace(fname, int(args.size) << 20)
+	if not gname:
+		gname = f'{tmp}/gold.txt'
+		gen_gold(gname, n // 10)
+
+old, to = timed('readline load_output', readline_load_output, fname)
+old = {k: (Helpers.hash(v['t']), v['a']) for k,v in old.items()}
+new, tn = timed('mmap load_output', Helpers.load_output, fname)
+new = {k: (Helpers.hash(v['t']), v['a']) for k,v in new.items()}
+print(f'Speedup {to/tn:.1f}x, results {"identical" if old == new else "DIFFER"}')
+
+if gname:
+	old, to = timed('readline load_gold', readline_load_gold, gname)
+	new, tn = timed('mmap load_gold', Helpers.load_gold, gname)
+	print(f'Speedup {to/tn:.1f}x, results {"identical" if old == new else "DIFFER"}')
+
+for f in os.listdir(tmp):
+	os.remove(f'{tmp}/{f}')
+os.rmdir(tmp)
@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import contextlib
+import email.utils
 import glob
+import hashlib
+import heapq
 import http.server
+import io
+import itertools
 import json
 import math
+import multiprocessing
 import os
+import pickle
+import queue
 import re
 import secrets
 import shutil
+import signal
 import subprocess
 import sys
 import tempfile
@@ -17,7 +28,7 @@ import time
 import urllib.parse
 import urllib.request
 import zlib
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from functools import partial
 from http import HTTPStatus
 from pathlib import Path
@@ -34,6 +45,8 @@ parser.add_argument('-s', '--step', action='store', help='Which step to focus on
 parser.add_argument('-g', '--gold', action='store', help='Whether to only show entries with specific gold status (*, w, u, m); defaults to ignoring gold', default='*')
 parser.add_argument('-z', '--pagesize', action='store', help='Page size; default to 250', default=250)
 parser.add_argument('-v', '--view', action='store', help='Which tool to show (regtest or inspect); defaults to regtest', default='regtest')
+parser.add_argument('-x', '--export', action='store_true', help='Write corpora in the deduplicated expected store out as plain expected files, then exit', default=False)
+parser.add_argument('-l', '--level', action='store', help='zlib level (0-9) for compressing callback responses; defaults to 1', default=1)
 parser.add_argument('-D', '--debug', action='store_true', help='Enable Python stack traces and other debugging', default=False)
 parser.add_argument('test', nargs='?', help='Which test to run; defaults to first defined', default='')
 cmdargs = parser.parse_args()
@@ -51,25 +64,112 @@ g_corps = Helpers.resolve_corps(g_root, g_config, g_test, cmdargs.corp)
 
 timeout = Helpers.timeout()
 timeout_sec = 1800 # Half an hour
+inspect_pool = 2 # Warm pipelines kept per test for the inspect view
+inspect_hang_sec = 60 # A warm pipeline that takes longer than this for one input is restarted
+journal_delay_sec = 5 # Accepts are journaled, and merged into the expected files once there have been none for this long
+git_delay_sec = 2 # Files to stage are collected for this long, then handed to git in one batch
+job_keep = 20 # Finished run jobs kept around for their status
+event_ping_sec = 15 # Event streams get a comment this often, so proxies don't close them while a run is quiet
+diff_cache_size = 20000 # Server-side diffs kept, keyed by (output digest, expected digest)
+diff_line_mode = 100 # Texts with at least this many lines are diffed by line instead of by word, same as the UI does
 
 Tests = {}
 Tests[g_tkey] = g_test
 
+class RWLock:
+	# Any number of readers or one writer; a waiting writer holds off new readers, so a stream of page loads can't starve an accept
+	def __init__(self):
+		self.cond = threading.Condition()
+		self.readers = 0
+		self.writer = False
+		self.waiting = 0
+
+	def acquire_read(self):
+		with self.cond:
+			while self.writer or self.waiting:
+				self.cond.wait()
+			self.readers += 1
+
+	def release_read(self):
+		with self.cond:
+			self.readers -= 1
+			if not self.readers:
+				self.cond.notify_all()
+
+	def acquire_write(self):
+		with self.cond:
+			self.waiting += 1
+			while self.writer or self.readers:
+				self.cond.wait()
+			self.waiting -= 1
+			self.writer = True
+
+	def release_write(self):
+		with self.cond:
+			self.writer = False
+			self.cond.notify_all()
+
+	@contextlib.contextmanager
+	def write(self):
+		self.acquire_write()
+		try:
+			yield
+		finally:
+			self.release_write()
+
 Locks = {}
-Locks[g_tkey] = threading.Lock()
+Locks[g_tkey] = RWLock()
+RunLocks = {}
+RunLocks[g_tkey] = threading.Lock()
+Running = set()
+
+Jobs = {}
+JobLock = threading.Condition()
+
+Assets = {}
+AssetLock = threading.Lock()
+
+Diffs = OrderedDict()
+DiffLock = threading.Lock()
+
+Terms = {}
+TermLock = threading.Lock()
+
+# Shared by all loads, and started from a forkserver, as forking the threaded server itself could deadlock the children
+ScanPool = None
+
+Pools = defaultdict(lambda: {
+	'fp': '',
+	'warm': '',
+	'cold': '',
+	'probing': '',
+	'count': 0,
+	'idle': [],
+	})
+PoolLock = threading.Lock()
+
+Journaled = defaultdict(set)
+JournalTimers = {}
+
+GitPending = defaultdict(lambda: {'add': set(), 'rm': set()})
+GitStatus = defaultdict(lambda: {'state': 'idle', 'pending': 0, 'staged': 0, 'error': '', 'time': 0})
+GitTimers = {}
+GitLock = threading.Lock()
+GitRunLock = threading.Lock()
 
 State = defaultdict(lambda: {
 	'corps': {},
 	'added': {},
 	'deleted': {},
 	'missing': {},
+	'timedout': {},
 	'changed_final': {},
 	'changed_any': {},
 	'golden': {},
 	'unchanged': {},
 	})
 
-def test_run(test, corps=[]):
+def test_run(test, corps=[], job=None):
 	tkey = test['test']
 
 	if not len(corps) or corps[0] == '' or corps[0] == '*':
@@ -79,18 +179,274 @@ def test_run(test, corps=[]):
 	#print('Running %s' % (' '.join(cmd)))
 	start = time.time()
 	good = False
+	# The state lock is only held around the state changes, so pages of the previous results can still be loaded while the runner goes
+	with RunLocks[tkey]:
+		with Locks[tkey].write():
+			# Loading after the run reads the expected files, so those have to be up to date
+			journal_flush(test)
+			Running.add(tkey)
+		try:
+			if job:
+				run_relay(cmd, job)
+			else:
+				run = subprocess.run(cmd, timeout=timeout_sec, check=True)
+			good = True
+		except Exception as e:
+			traceback.print_exception(e)
+		finally:
+			with Locks[tkey].write():
+				Running.discard(tkey)
+				if good and tkey in State:
+					del State[tkey]
+	print('Run took %.2f seconds' % (time.time() - start))
+
+	return good, ' '.join(cmd)
+
+def run_relay(cmd, job):
+	# Echoes the runner's output to the terminal as before, and turns it into job events on the way
+	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	killer = threading.Timer(timeout_sec, proc.kill)
+	killer.daemon = True
+	killer.start()
+	# Progress lines end in \r, so lines are split on that too, and the ends are kept for the terminal
+	for l in io.TextIOWrapper(proc.stdout, encoding='UTF-8', errors='replace', newline=''):
+		print(l, end='', flush=True)
+		l = l.strip()
+		if m := re.match(r'^Progress: (\d+)% \((\d+) of (\d+)', l):
+			if job['progress'].get('pct') != int(m[1]):
+				job['progress'] = {'pct': int(m[1]), 'done': int(m[2]), 'todo': int(m[3])}
+				job_event(job, 'progress', **job['progress'])
+		elif l.startswith('Steps: '):
+			job['steps'] = {p: r for p,r in (x.rsplit(' ', 1) for x in l[7:].split(', '))}
+			job_event(job, 'steps', steps=job['steps'])
+		elif l:
+			job_event(job, 'line', text=l)
+	proc.wait()
+	killer.cancel()
+	if proc.returncode:
+		raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def job_event(job, type, **kw):
+	with JobLock:
+		job['events'].append(dict(type=type, **kw))
+		JobLock.notify_all()
+
+def job_start(test, corps):
+	tkey = test['test']
+	with JobLock:
+		# Asking again while a run of this test is going just hands back that run
+		for job in Jobs.values():
+			if job['test'] == tkey and job['state'] == 'running':
+				return job
+		job = {
+			'id': secrets.token_hex(8),
+			'test': tkey,
+			'corps': corps,
+			'state': 'running',
+			'good': None,
+			'cmd': '',
+			'started': time.time(),
+			'ended': 0,
+			'progress': {},
+			'steps': {},
+			'events': [],
+			}
+		Jobs[job['id']] = job
+		done = sorted((j for j in Jobs.values() if j['state'] != 'running'), key=lambda j: j['ended'])
+		for j in done[:max(0, len(done) - job_keep)]:
+			del Jobs[j['id']]
+
+	threading.Thread(target=job_thread, args=(test, job), daemon=True).start()
+	return job
+
+def job_thread(test, job):
+	good, cmd = False, ''
 	try:
-		run = subprocess.run(cmd, timeout=1800, check=True)
-		good = True
-		if tkey in State:
-			del State[tkey]
+		good, cmd = test_run(test, job['corps'], job)
 	except Exception as e:
 		traceback.print_exception(e)
-	print('Run took %.2f seconds' % (time.time() - start))
+	with JobLock:
+		job['good'] = good
+		job['cmd'] = cmd
+		job['ended'] = time.time()
+		job['state'] = 'done' if good else 'failed'
+		job['events'].append({'type': 'done', 'good': good, 'cmd': cmd, 'secs': job['ended'] - job['started']})
+		JobLock.notify_all()
+
+def job_status(job):
+	# Everything but the event log, which is what /events streams
+	with JobLock:
+		rv = {k: v for k,v in job.items() if k != 'events'}
+		rv['events'] = len(job['events'])
+	return rv
 
-	return good, ' '.join(cmd)
+def load_texts(test, es):
+	# Returns copies of the state entries with the digests replaced by the actual texts
+	tkey = test['test']
+	# While a run rewrites the output files, texts that no longer match the state are left out
+	check = tkey in Running
+	rv = []
+	byc = defaultdict(list)
+	for e in es:
+		n = {k: v for k,v in e.items() if k != 'gd'}
+		n['i'] = ''
+		n['o'] = ['']*len(test['all_steps'])
+		n['e'] = ['']*len(test['all_steps'])
+		rv.append(n)
+		# Deleted entries only have expected texts, and are marked with line 0
+		cs = [c for c,l in e['c'].items() if l != 0] or list(e['c'].keys())
+		if cs:
+			byc[cs[0]].append((e, n))
+
+	for c,ens in byc.items():
+		local = ''
+		if '/local/' in test['all_corpora'][c]:
+			local = '/local'
+		ns = [n for _,n in ens]
+		ids = [n['h'] for n in ns]
+		blobs, man = Helpers.store_paths(g_root, test, c)
+		if not test['dedup'] or not os.path.exists(man):
+			blobs = None
+
+		segs = Helpers.fetch_segments(g_root, tkey, f'{g_root}/output/{tkey}/{c}/output-{c}-010.txt', ids)
+		for e,n in ens:
+			if n['h'] in segs and (not check or Helpers.digest(segs[n['h']]['t']) == e['i']):
+				n['i'] = segs[n['h']]['t']
+
+		for i,k in enumerate(test['all_steps']):
+			segs = Helpers.fetch_segments(g_root, tkey, f'{g_root}/output/{tkey}/{c}/output-{c}-{k}.txt', ids)
+			for e,n in ens:
+				if n['h'] in segs and (not check or Helpers.digest(segs[n['h']]['t']) == e['o'][i]):
+					n['o'][i] = segs[n['h']]['t']
+			if k.endswith('-trace'):
+				continue
+			# Accepted texts may so far only be in the journal, but they equal the output then
+			rest = []
+			for e,n in ens:
+				if e['e'][i] == e['o'][i]:
+					n['e'][i] = n['o'][i]
+				else:
+					rest.append((e, n))
+			if blobs:
+				# The store is keyed by the digests already held in state
+				segs = Helpers.fetch_segments(g_root, tkey, blobs, [e['e'][i] for e,_ in rest])
+				for e,n in rest:
+					if e['e'][i] in segs:
+						n['e'][i] = segs[e['e'][i]]['t']
+				continue
+			segs = Helpers.fetch_segments(g_root, tkey, f'{g_root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt', [n['h'] for _,n in rest])
+			for _,n in rest:
+				if n['h'] in segs:
+					n['e'][i] = segs[n['h']]['t']
+
+	return rv
+
+def diff_hunks(od, ed, o, e):
+	key = (od, ed)
+	with DiffLock:
+		if key in Diffs:
+			Diffs.move_to_end(key)
+			return Diffs[key]
+
+	rv = Helpers.diff_texts(o, e, diff_line_mode)
+
+	with DiffLock:
+		Diffs[key] = rv
+		while len(Diffs) > diff_cache_size:
+			Diffs.popitem(last=False)
+	return rv
+
+def diff_entry(test, e, n):
+	# Compact form of a loaded entry: a changed step only carries its hunks in 'd', an output seen in an earlier step is the index of that step, and an expected text equal to the output is None
+	rv = dict(n)
+	rv['o'] = list(n['o'])
+	rv['e'] = list(n['e'])
+	rv['d'] = [None]*len(n['o'])
+	seen = {}
+	# While a run rewrites the outputs, load_texts() may have blanked texts, and a diff of those must not be cached under the real digests
+	running = test['test'] in Running
+	for i,k in enumerate(test['all_steps']):
+		od, ed = e['o'][i], e['e'][i]
+		if not k.endswith('-trace') and od and ed and od != ed and not running and n['o'][i] and n['e'][i]:
+			rv['d'][i] = diff_hunks(od, ed, n['o'][i], n['e'][i])
+			rv['o'][i] = None
+			rv['e'][i] = None
+		else:
+			if od in seen:
+				rv['o'][i] = seen[od]
+			if ed == od:
+				rv['e'][i] = None
+		if od and n['o'][i]:
+			seen.setdefault(od, i)
+	return rv
 
-def cb_load(test, corps=[], gold='*', page=0, pagesize=250):
+def scan_digests(test, fn, greps=None, attrs=False):
+	# Yields (id, digest, attributes) straight from the offset index, unless grep needs to see the texts
+	if greps is not None and test['grep']:
+		for id,e in Helpers.iter_output(fn):
+			if re.search(test['grep'], e['t']):
+				greps.add(id)
+			yield id, Helpers.digest(e['t']), e['a']
+		return
+
+	index = Helpers.load_index(fn, Helpers.index_path(g_root, test['test'], fn))
+	with open(fn, 'rb') as fd:
+		for id,a,_,d in index.items():
+			at = {}
+			if attrs:
+				fd.seek(a)
+				_, e = Helpers.parse_segment(fd.readline())
+				at = e['a']
+			yield id, d, at
+
+def scan_file(test, fn, grep, attrs):
+	# Runs in cb_load()'s pool, so hands back plain lists for the parent to merge
+	greps = None
+	if grep:
+		greps = set()
+	return list(scan_digests(test, fn, greps, attrs)), greps or set()
+
+def snapshot_sig(test, c, local, store):
+	tkey = test['test']
+	fs = [f'{g_root}/output/{tkey}/corp-{c}.ids', f'{g_root}/output/{tkey}/corp-{c}.timeouts', f'{g_root}/output/{tkey}/{c}/output-{c}-010.txt']
+	for k in test['all_steps']:
+		fs.append(f'{g_root}/output/{tkey}/{c}/output-{c}-{k}.txt')
+		if not k.endswith('-trace') and not store:
+			fs.append(f'{g_root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt')
+	fs.append(f'{g_root}{local}/expected/{tkey}/{c}/gold-{c}.txt')
+
+	# Sizes and mtimes stand in for the file contents, same as for the offset indexes
+	sig = ['regtest-state-2', test['all_steps'], test['grep']]
+	for f in fs:
+		try:
+			st = os.stat(f)
+			sig.append((f, st.st_size, st.st_mtime_ns))
+		except FileNotFoundError:
+			sig.append((f, None))
+	return sig
+
+def snapshot_load(tkey, c, sig):
+	# The signature is pickled separately in front, so a stale snapshot is rejected without unpickling the rest
+	try:
+		with open(f'{g_root}/output/{tkey}/_state/{c}.pickle', 'rb') as fd:
+			if pickle.load(fd) == sig:
+				return pickle.load(fd)
+	except (OSError, EOFError, pickle.UnpicklingError):
+		pass
+	return None
+
+def snapshot_save(tkey, c, sig, res):
+	fn = f'{g_root}/output/{tkey}/_state/{c}.pickle'
+	try:
+		os.makedirs(os.path.dirname(fn), exist_ok=True)
+		with open(f'{fn}.new', 'wb') as fd:
+			pickle.dump(sig, fd, protocol=pickle.HIGHEST_PROTOCOL)
+			pickle.dump(res, fd, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(f'{fn}.new', fn)
+	except OSError:
+		pass
+
+def cb_load(test, corps=[], gold='*', page=0, pagesize=250, diffs=False):
 	tkey = test['test']
 	state = State[tkey]
 	if not gold or gold == '':
@@ -105,6 +461,7 @@ def cb_load(test, corps=[], gold='*', page=0, pagesize=250):
 		'o': ['']*len(test['all_steps']),
 		'e': ['']*len(test['all_steps']),
 		'g': [],
+		'gd': [],
 		'gs': '*',
 		'c': {},
 		})
@@ -116,66 +473,124 @@ def cb_load(test, corps=[], gold='*', page=0, pagesize=250):
 
 	greps = set()
 
-	for c in corps:
-		if c in state['corps']:
-			continue
-
+	# Scanning the files is independent per corpus and step, so that is fanned out over a pool, while merging and classifying stays here in corpus order
+	todo = [c for c in corps if c not in state['corps']]
+	loads = []
+	for c in todo:
 		local = ''
 		if '/local/' in test['all_corpora'][c]:
 			local = '/local'
 
 		print(f'Loading {c}')
 
-		ids = {}
-		with open(f'{g_root}/output/{tkey}/corp-{c}.ids', 'r') as fd:
-			while l := fd.readline():
-				l = l.strip().split('\t')
-				ids[l[0]] = l[1]
+		# Left over from a server that didn't get to merge its journal
+		if Helpers.compact_journal(g_root, test, c):
+			Journaled[tkey].discard(c)
+			needs_cleanup = True
+
+		# A corpus switches to the deduplicated store on its first save_expected(), and back to plain files here
+		blobs, man = Helpers.store_paths(g_root, test, c)
+		store = None
+		gdigs = set()
+		if test['dedup'] and os.path.exists(man):
+			store = Helpers.load_manifest(man)
+			if test['grep']:
+				gdigs = {d for d,e in Helpers.iter_output(blobs) if re.search(test['grep'], e['t'])}
+		elif os.path.exists(man):
+			Helpers.export_expected(g_root, test, c)
+			print(f'{c} was in the deduplicated store - exported it to plain expected files')
+			needs_cleanup = True
+
+		for k in test['all_steps']:
+			if k.endswith('-trace') or store is not None:
+				continue
+			if not os.path.exists(f'{g_root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt'):
+				os.makedirs(f'{g_root}{local}/expected/{tkey}/{c}/', exist_ok=True)
+				shutil.copy2(f'{g_root}/output/{tkey}/{c}/output-{c}-{k}.txt', f'{g_root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt')
+				print(f'{c}-{k} was new - copied output to expected')
+				needs_cleanup = True
+
+		# Reuse the scan results from an earlier load if none of the files they came from have changed since
+		sig = snapshot_sig(test, c, local, store is not None)
+		res = snapshot_load(tkey, c, sig)
+		jobs = {}
+		if res is None:
+			jobs['i'] = ScanPool.submit(scan_file, test, f'{g_root}/output/{tkey}/{c}/output-{c}-010.txt', False, True)
+			for i,k in enumerate(test['all_steps']):
+				jobs['o', i] = ScanPool.submit(scan_file, test, f'{g_root}/output/{tkey}/{c}/output-{c}-{k}.txt', True, False)
+				if k.endswith('-trace') or store is not None:
+					continue
+				jobs['e', i] = ScanPool.submit(scan_file, test, f'{g_root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt', True, i == 0)
+		loads.append((c, local, store, gdigs, sig, res, jobs))
+
+	for c, local, store, gdigs, sig, res, jobs in loads:
+		if res is None:
+			res = {k: f.result() for k,f in jobs.items()}
+			res['ids'] = {}
+			with open(f'{g_root}/output/{tkey}/corp-{c}.ids', 'r') as fd:
+				while l := fd.readline():
+					l = l.strip().split('\t')
+					res['ids'][l[0]] = l[1]
+			# Inputs the runner's watchdog gave up on, with the step each got stuck in
+			res['t'] = {}
+			if os.path.exists(f'{g_root}/output/{tkey}/corp-{c}.timeouts'):
+				with open(f'{g_root}/output/{tkey}/corp-{c}.timeouts', 'r') as fd:
+					for l in fd:
+						l = l.strip().split('\t')
+						res['t'][l[0]] = l[1]
+			res['g'] = {}
+			if os.path.exists(f'{g_root}{local}/expected/{tkey}/{c}/gold-{c}.txt'):
+				res['g'] = Helpers.load_gold(f'{g_root}{local}/expected/{tkey}/{c}/gold-{c}.txt')
+			snapshot_save(tkey, c, sig, res)
+
+		ids = res['ids']
+		tos = res['t']
 		state['corps'][c] = ids
 
-		ins = Helpers.load_output(f'{g_root}/output/{tkey}/{c}/output-{c}-010.txt')
-		for id,e in ins.items():
+		# Only digests of the texts are kept in state, the texts themselves are fetched per page by load_texts()
+		rows, _ = res['i']
+		for id,d,a in rows:
 			data[id]['c'][c] = ids[id]
 			data[id]['h'] = id
-			data[id]['i'] = e['t']
-			data[id]['a'] = e['a']
+			data[id]['i'] = d
+			data[id]['a'] = a
 
 		for i,k in enumerate(test['all_steps']):
-			outs = Helpers.load_output(f'{g_root}/output/{tkey}/{c}/output-{c}-{k}.txt')
-			for id,e in outs.items():
-				data[id]['o'][i] = e['t']
-				if test['grep'] and re.search(test['grep'], e['t']):
-					greps.add(id)
+			rows, gs = res['o', i]
+			greps |= gs
+			for id,d,_ in rows:
+				data[id]['o'][i] = d
 
 			if k.endswith('-trace'):
 				continue
 
-			if not os.path.exists(f'{g_root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt'):
-				os.makedirs(f'{g_root}{local}/expected/{tkey}/{c}/', exist_ok=True)
-				shutil.copy2(f'{g_root}/output/{tkey}/{c}/output-{c}-{k}.txt', f'{g_root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt')
-				print(f'{c}-{k} was new - copied output to expected')
-				needs_cleanup = True
+			if store is not None:
+				exps = [(id, e['e'].get(k, ''), e['a']) for id,e in store.items()]
+				greps |= {id for id,d,_ in exps if d in gdigs}
+			else:
+				exps, gs = res['e', i]
+				greps |= gs
 
-			exps = Helpers.load_output(f'{g_root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt')
-			for id,e in exps.items():
-				data[id]['e'][i] = e['t']
-				if test['grep'] and re.search(test['grep'], e['t']):
-					greps.add(id)
+			for id,d,a in exps:
+				data[id]['e'][i] = d
 				if i == 0 and not data[id]['i']:
 					data[id]['c'][c] = 0
 					data[id]['h'] = id
-					data[id]['a'] = e['a']
+					data[id]['a'] = a
 					state['deleted'][id] = data[id]
-				if i == len(test['all_steps'])-1 and not data[id]['o'][i] and id not in state['deleted']:
+				if i == len(test['all_steps'])-1 and not data[id]['o'][i] and id not in state['deleted'] and id not in tos:
 					state['missing'][id] = data[id]
 
-		if os.path.exists(f'{g_root}{local}/expected/{tkey}/{c}/gold-{c}.txt'):
-			golds = Helpers.load_gold(f'{g_root}{local}/expected/{tkey}/{c}/gold-{c}.txt')
-			for id,e in golds.items():
-				if id in data:
-					data[id]['g'] = e
+		for id,e in res['g'].items():
+			if id in data:
+				data[id]['g'] = e
+				data[id]['gd'] = [Helpers.digest(g) for g in e]
 
 		for id in ids.keys():
+			if id in tos:
+				data[id]['to'] = tos[id]
+				state['timedout'][id] = data[id]
+				continue
 			if not data[id]['e'][0]:
 				state['added'][id] = data[id]
 				continue
@@ -190,7 +605,7 @@ def cb_load(test, corps=[], gold='*', page=0, pagesize=250):
 					change = i+1
 
 			if data[id]['g']:
-				if data[id]['o'][-1] in set(data[id]['g']):
+				if data[id]['o'][-1] in set(data[id]['gd']):
 					data[id]['gs'] = 'm'
 					state['golden'][id] = data[id]
 					continue
@@ -209,7 +624,7 @@ def cb_load(test, corps=[], gold='*', page=0, pagesize=250):
 		for id in greps:
 			if id in data:
 				del data[id]
-			for s in ['added', 'deleted', 'missing', 'changed_final', 'changed_any', 'golden', 'unchanged']:
+			for s in ['added', 'deleted', 'missing', 'timedout', 'changed_final', 'changed_any', 'golden', 'unchanged']:
 				if id in state[s]:
 					del state[s][id]
 		if needs_cleanup:
@@ -231,6 +646,7 @@ def cb_load(test, corps=[], gold='*', page=0, pagesize=250):
 			'added': [],
 			'deleted': [],
 			'missing': [],
+			'timedout': [],
 			'changed_final': [],
 			'changed_any': [],
 			'golden': [],
@@ -238,9 +654,10 @@ def cb_load(test, corps=[], gold='*', page=0, pagesize=250):
 		},
 	}
 
-	for s in ['added', 'deleted', 'missing']:
+	es = []
+	for s in ['added', 'deleted', 'missing', 'timedout']:
 		for k,v in state[s].items():
-			rv['results'][s].append(v)
+			es.append((s, v))
 
 	corps = set(corps)
 	i = 0
@@ -255,13 +672,166 @@ def cb_load(test, corps=[], gold='*', page=0, pagesize=250):
 				continue
 			if i >= page*pagesize + pagesize:
 				break
-			rv['results'][s].append(v)
+			es.append((s, v))
+
+	for (s, e), v in zip(es, load_texts(test, [v for _, v in es])):
+		if diffs:
+			v = diff_entry(test, e, v)
+		rv['results'][s].append(v)
 
 	if needs_cleanup:
 		do_cleanup(test)
 
 	return rv
 
+def get_terms(tkey, fname):
+	# Kept in memory until the file changes, so repeated searches don't unpickle again
+	st = os.stat(fname)
+	with TermLock:
+		terms = Terms.get(fname)
+	if not terms or terms['stat'] != (st.st_size, st.st_mtime_ns):
+		terms = Helpers.load_terms(fname, Helpers.terms_path(g_root, tkey, fname))
+		with TermLock:
+			Terms[fname] = terms
+	return terms
+
+def cb_search(test, q, rx=False, corps=[], steps=[], page=0, pagesize=250):
+	tkey = test['test']
+	if not len(corps) or corps[0] == '' or corps[0] == '*':
+		corps = list(test['all_corpora'].keys())
+	if not len(steps) or steps[0] == '' or steps[0] == '*':
+		steps = test['all_steps']
+
+	if rx:
+		rx = re.compile(q)
+		words = Helpers.regex_words(q)
+		found = lambda t: rx.search(t)
+	else:
+		words = Helpers.RE_TERM.findall(q)
+		found = lambda t: q in t
+
+	hits = defaultdict(list)
+	lines = {}
+	for c in corps:
+		local = ''
+		if '/local/' in test['all_corpora'][c]:
+			local = '/local'
+		with open(f'{g_root}/output/{tkey}/corp-{c}.ids', 'r') as fd:
+			for l in fd:
+				l = l.strip().split('\t')
+				lines.setdefault(l[0], {})[c] = int(l[1])
+
+		blobs, man = Helpers.store_paths(g_root, test, c)
+		store = Helpers.load_manifest(man) if test['dedup'] and os.path.exists(man) else None
+		for k in steps:
+			fns = [('o', f'{g_root}/output/{tkey}/{c}/output-{c}-{k}.txt')]
+			if not k.endswith('-trace'):
+				fns.append(('e', blobs if store is not None else f'{g_root}{local}/expected/{tkey}/{c}/expected-{c}-{k}.txt'))
+			for w,fn in fns:
+				if not os.path.exists(fn):
+					continue
+				# Only the segments the word index can't rule out are read and matched for real
+				terms = get_terms(tkey, fn)
+				ns = Helpers.match_terms(terms, words)
+				ids = terms['ids'] if ns is None else [terms['ids'][n] for n in ns]
+				segs = Helpers.fetch_segments(g_root, tkey, fn, ids)
+				ids = {id for id,e in segs.items() if found(e['t'])}
+				if store is not None and w == 'e':
+					# The store's segments are keyed by digest
+					ids = {id for id,e in store.items() if e['e'].get(k, '') in ids}
+				for id in ids:
+					hits[id].append(f'{w}:{k}')
+
+	# Same order as the corpora and their lines
+	order = {c: i for i,c in enumerate(corps)}
+	ids = sorted(hits, key=lambda id: min(((order[c], l) for c,l in lines.get(id, {}).items() if c in order), default=(len(order), 0)))
+	rv = {
+		'counts': {
+			'total': len(ids),
+			'page': page,
+			'pages': math.ceil(len(ids) / pagesize),
+		},
+		'results': [],
+	}
+
+	# Entries already loaded into state come with their texts, like from load
+	state = State[tkey] if tkey in State else {}
+	where = {}
+	for s in ['added', 'deleted', 'missing', 'timedout', 'changed_final', 'changed_any', 'golden', 'unchanged']:
+		for id,e in state.get(s, {}).items():
+			where.setdefault(id, (s, e))
+	ids = ids[page*pagesize:page*pagesize + pagesize]
+	es = [where[id][1] for id in ids if id in where]
+	texts = dict(zip([e['h'] for e in es], load_texts(test, es)))
+	for id in ids:
+		r = {'h': id, 'c': lines.get(id, {}), 'm': hits[id]}
+		if id in texts:
+			r['b'] = where[id][0]
+			r['e'] = texts[id]
+		rv['results'].append(r)
+
+	return rv
+
+def cb_timings(test, corps=[], steps=[], n=20):
+	tkey = test['test']
+	if not len(corps) or corps[0] == '' or corps[0] == '*':
+		corps = list(test['all_corpora'].keys())
+	if not len(steps) or steps[0] == '' or steps[0] == '*':
+		steps = list(test['steps'].keys())
+
+	# The runner writes how long each step took on each input next to the corpus ids
+	times = defaultdict(dict)
+	lines = {}
+	for c in corps:
+		with open(f'{g_root}/output/{tkey}/corp-{c}.ids', 'r') as fd:
+			for l in fd:
+				l = l.strip().split('\t')
+				lines.setdefault(l[0], {})[c] = int(l[1])
+		if not os.path.exists(f'{g_root}/output/{tkey}/corp-{c}.times'):
+			continue
+		with open(f'{g_root}/output/{tkey}/corp-{c}.times', 'r') as fd:
+			for l in fd:
+				id, p, t = l.rstrip('\n').split('\t')
+				times[p][id] = float(t)
+
+	rv = {'steps': {}}
+	slow = set()
+	for p in steps:
+		secs = sorted(times[p].values())
+		st = {
+			'count': len(secs),
+			'total': sum(secs),
+			'mean': sum(secs) / max(len(secs), 1),
+			}
+		for q in [50, 90, 99]:
+			st[f'p{q}'] = secs[max(0, math.ceil(q * len(secs) / 100) - 1)] if secs else 0
+		st['max'] = secs[-1] if secs else 0
+		st['hist'] = []
+		st['slowest'] = []
+		# Doubling buckets from a millisecond up, each counting the inputs that took at most its bound
+		bound = 0.001
+		i = 0
+		while i < len(secs):
+			k = i
+			while k < len(secs) and secs[k] <= bound:
+				k += 1
+			st['hist'].append([bound, k - i])
+			i = k
+			bound *= 2
+		for id,t in heapq.nlargest(n, times[p].items(), key=lambda x: x[1]):
+			st['slowest'].append({'h': id, 'c': lines.get(id, {}), 's': t})
+			slow.add(id)
+		rv['steps'][p] = st
+
+	# The inputs themselves, read from the first corpus each occurs in
+	rv['inputs'] = {}
+	for c in corps:
+		ids = [id for id in slow if c in lines.get(id, {}) and id not in rv['inputs']]
+		for id,e in Helpers.fetch_segments(g_root, tkey, f'{g_root}/output/{tkey}/{c}/output-{c}-010.txt', ids).items():
+			rv['inputs'][id] = e['t']
+
+	return rv
+
 def cb_accept_nd(test, c):
 	tkey = test['test']
 	state = State[tkey]
@@ -283,14 +853,15 @@ def cb_accept_nd(test, c):
 			continue
 		rv.append(id)
 
+	drops = []
 	for id in rv:
 		if id in state['added']:
 			del state['added'][id]
 		if id in state['deleted']:
 			del state['deleted'][id]
+			drops.append(id)
 
-	Helpers.save_expected(g_root, test, c, state)
-	do_cleanup(test)
+	save_accepted(test, [c], [state['unchanged'][id] for id in rv if id in state['unchanged']], drops)
 
 	return rv
 
@@ -303,6 +874,7 @@ def cb_accept(test, hs, step):
 		step = test['all_steps'][-1]
 
 	cs = set()
+	es = []
 	for id in hs:
 		e = None
 		for s in ['changed_final', 'changed_any', 'golden', 'unchanged']:
@@ -311,6 +883,7 @@ def cb_accept(test, hs, step):
 			rv.append(id)
 			e = state[s][id]
 			cs |= set(e['c'].keys())
+			es.append(e)
 
 			for i,k in enumerate(test['all_steps']):
 				if k.endswith('-trace'):
@@ -329,10 +902,7 @@ def cb_accept(test, hs, step):
 				del state[s][id]
 			state[s][id] = e
 
-	for c in cs:
-		Helpers.save_expected(g_root, test, c, state)
-	if cs:
-		do_cleanup(test)
+	save_accepted(test, cs, es)
 
 	return rv
 
@@ -341,7 +911,7 @@ def cb_gold(test, hs, a='add', gs=[]):
 	state = State[tkey]
 	rv = []
 
-	cs = set()
+	recs = defaultdict(list)
 	for id in hs:
 		e = None
 		for s in ['changed_final', 'changed_any', 'golden', 'unchanged']:
@@ -349,51 +919,240 @@ def cb_gold(test, hs, a='add', gs=[]):
 				continue
 			rv.append(id)
 			e = state[s][id]
-			cs |= set(e['c'].keys())
 
 		if not e:
 			continue
 
 		if a == 'add':
-			e['g'] = sorted(list(set(e['g']).add(e['o'][-1])))
+			e['g'] = sorted(set(e['g']) | {load_texts(test, [e])[0]['o'][-1]})
 		elif a == 'set':
 			e['g'] = sorted(list(set(gs)))
 		else:
-			e['g'] = [e['o'][-1]]
+			e['g'] = [load_texts(test, [e])[0]['o'][-1]]
+		e['gd'] = [Helpers.digest(g) for g in e['g']]
+		for c in e['c'].keys():
+			recs[c].append({'id': id, 'g': e['g']})
 
-	for c in cs:
-		Helpers.save_gold(g_root, test, c, state)
-	if cs:
-		do_cleanup(test)
+	for c,rs in recs.items():
+		journal_write(test, c, rs)
 
 	return rv
 
-def do_inspect(test, input):
+def save_accepted(test, cs, es, drops=[]):
+	# Writes what was accepted in the given corpora - straight into the deduplicated store, or else as journal records
+	if test['dedup']:
+		for c in cs:
+			Helpers.save_expected(g_root, test, c, State[test['test']])
+		if cs:
+			do_cleanup(test)
+		return
+
+	recs = defaultdict(list)
+	for e,n in zip(es, load_texts(test, es)):
+		for i,k in enumerate(test['all_steps']):
+			if k.endswith('-trace') or e['e'][i] != e['o'][i]:
+				continue
+			for c in cs:
+				if e['c'].get(c, 0) != 0:
+					recs[c].append({'id': e['h'], 's': k, 'a': e['a'], 't': n['o'][i]})
+	for c in cs:
+		for id in drops:
+			recs[c].append({'id': id, 'del': 1})
+
+	for c,rs in recs.items():
+		journal_write(test, c, rs)
+
+def journal_write(test, c, recs):
 	tkey = test['test']
-	tdir = tempfile.gettempdir()
+	Helpers.journal_append(g_root, tkey, c, recs)
+	Journaled[tkey].add(c)
+
+	# Debounce, so a burst of accepts only rewrites each corpus once
+	if tkey in JournalTimers:
+		JournalTimers[tkey].cancel()
+	JournalTimers[tkey] = threading.Timer(journal_delay_sec, journal_later, [test])
+	JournalTimers[tkey].daemon = True
+	JournalTimers[tkey].start()
+
+def journal_later(test):
+	with Locks[test['test']].write():
+		journal_flush(test)
+
+def journal_flush(test):
+	# Merges pending journals into the sorted expected and gold files, and only then hands those to git; caller holds Locks[tkey]
+	tkey = test['test']
+	if not Journaled[tkey]:
+		return
+	for c in sorted(Journaled.pop(tkey)):
+		Helpers.compact_journal(g_root, test, c)
+	do_cleanup(test)
 
+def inspect_pipe(test, base, timeouts=True):
 	pipe = ''
+	files = {}
 	for p,s in test['steps'].items():
 		# Every step gets its own timeout watcher, to avoid runaway background processes
-		pipe += f' | {timeout} {timeout_sec} {s["cmd"]}'
+		if timeouts:
+			pipe += f' | {timeout} {timeout_sec} {s["cmd"]}'
+		else:
+			pipe += f' | {s["cmd"]}'
+		files[p] = f'{base}-{p}.txt'
 		if 'trace' in s:
-			pipe += f' {s["trace"]} | tee {tdir}/inspect-{tkey}-{p}-trace.txt'
+			pipe += f' {s["trace"]} | tee {base}-{p}-trace.txt'
+			files[f'{p}-trace'] = f'{base}-{p}-trace.txt'
 		elif s['type'] == 'cg':
-			pipe += f' --trace | cg-sort | tee {tdir}/inspect-{tkey}-{p}-trace.txt | cg-untrace | cg-sort'
-		pipe += f' | tee {tdir}/inspect-{tkey}-{p}.txt'
+			pipe += f' --trace | cg-sort | tee {base}-{p}-trace.txt | cg-untrace | cg-sort'
+			files[f'{p}-trace'] = f'{base}-{p}-trace.txt'
+		pipe += f' | tee {base}-{p}.txt'
 	pipe = pipe.replace(' --trace --trace ', ' --trace ')
 	pipe = pipe.replace(' cg3-autobin.pl ', ' vislcg3 ')
-	pipe = pipe[3:]
 
-	Path(f'{tdir}/inspect-{tkey}.sh').write_text(f"cat '{tdir}/inspect-{tkey}.input' | {pipe} >/dev/null")
-	Path(f'{tdir}/inspect-{tkey}.input').write_text(input)
-	subprocess.run([timeout, str(timeout_sec), 'nice', '-n20', 'bash', f'{tdir}/inspect-{tkey}.sh'])
+	env = ''
+	for e in test['env']:
+		env += f'export "{e}"\n'
+
+	return env, pipe[3:], files
+
+def pool_read(w):
+	for l in w['proc'].stdout:
+		if l.startswith('<STREAMCMD:FLUSH>'):
+			w['flushes'].put(True)
+
+def pool_stop(w):
+	try:
+		os.killpg(w['proc'].pid, signal.SIGKILL)
+	except ProcessLookupError:
+		pass
+	w['proc'].wait()
+	for fn in [f'{w["base"]}.sh'] + list(w['files'].values()):
+		Path(fn).unlink(missing_ok=True)
+
+def pool_fingerprint(test):
+	fps = Helpers.step_fingerprints(test['steps'], test['env'])
+	return fps[next(reversed(fps))]
+
+def pool_get(test, fp):
+	tkey = test['test']
+
+	with PoolLock:
+		pool = Pools[tkey]
+		if pool['fp'] != fp:
+			# Grammars or binaries changed, so the warm pipelines are stale
+			for w in pool['idle']:
+				pool_stop(w)
+			pool['fp'] = fp
+			pool['idle'] = []
+		if pool['idle']:
+			return pool['idle'].pop()
+		pool['count'] += 1
+		n = pool['count']
+
+	# Workers run without the per-step timeout watchers, since they live for as long as the server does
+	base = f'{tempfile.gettempdir()}/inspect-{tkey}-{g_nonce}-{n}'
+	env, pipe, files = inspect_pipe(test, base, False)
+	Path(f'{base}.sh').write_text(env + pipe)
+	w = {
+		'fp': fp,
+		'base': base,
+		'files': files,
+		'offsets': dict.fromkeys(files.keys(), 0),
+		'flushes': queue.Queue(),
+		'proc': subprocess.Popen(['nice', '-n20', 'bash', f'{base}.sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='UTF-8', start_new_session=True),
+		}
+	threading.Thread(target=pool_read, args=(w,), daemon=True).start()
+	return w
+
+def pool_put(test, w):
+	with PoolLock:
+		pool = Pools[test['test']]
+		if w['fp'] == pool['fp'] and len(pool['idle']) < inspect_pool:
+			pool['idle'].append(w)
+			return
+	pool_stop(w)
+
+def pool_inspect(w, input):
+	try:
+		w['proc'].stdin.write(f'{input}\n\n<STREAMCMD:FLUSH>\n\n')
+		w['proc'].stdin.flush()
+		w['flushes'].get(timeout=inspect_hang_sec)
+	except (BrokenPipeError, queue.Empty):
+		return None
 
 	rv = {}
-	for p,s in test['steps'].items():
-		rv[p] = Path(f'{tdir}/inspect-{tkey}-{p}.txt').read_text()
-		if 'trace' in s or s['type'] == 'cg':
-			rv[f'{p}-trace'] = Path(f'{tdir}/inspect-{tkey}-{p}-trace.txt').read_text()
+	for k,fn in w['files'].items():
+		# tee may write to its file a moment after passing the data on, so wait for the flush marker to show up
+		until = time.time() + 5
+		while True:
+			data = b''
+			if os.path.exists(fn):
+				with open(fn, 'rb') as fd:
+					fd.seek(w['offsets'][k])
+					data = fd.read()
+			if m := re.search(rb'(?:^|\n)<STREAMCMD:FLUSH>\n', data):
+				break
+			if time.time() > until:
+				return None
+			time.sleep(0.01)
+		w['offsets'][k] += m.end()
+		rv[k] = data[:m.start()].decode('UTF-8').strip() + '\n'
+
+	return rv
+
+def pool_probe(test, fp):
+	# Only a flush marker goes in, so no inspect has to wait to find out whether the pipe passes it on
+	tkey = test['test']
+	pool = Pools[tkey]
+	w = pool_get(test, fp)
+	if pool_inspect(w, '') is None:
+		pool_stop(w)
+		print(f'Pipe for {tkey} does not flush on <STREAMCMD:FLUSH> - using cold runs for inspect')
+		pool['cold'] = fp
+	else:
+		pool['warm'] = fp
+		pool_put(test, w)
+
+def pool_start(test):
+	# Probes a new pipe in the background, and returns its fingerprint
+	fp = pool_fingerprint(test)
+	pool = Pools[test['test']]
+	with PoolLock:
+		if fp in [pool['warm'], pool['cold'], pool['probing']]:
+			return fp
+		pool['probing'] = fp
+	threading.Thread(target=pool_probe, args=(test, fp), daemon=True).start()
+	return fp
+
+def do_inspect(test, input):
+	tkey = test['test']
+	tdir = tempfile.gettempdir()
+
+	# Until the probe has shown that the pipe flushes, inspects run cold
+	fp = pool_start(test)
+	pool = Pools[tkey]
+	if pool['warm'] == fp:
+		w = pool_get(test, fp)
+		rv = pool_inspect(w, input)
+		if rv is not None:
+			pool_put(test, w)
+			return rv
+		pool_stop(w)
+		print(f'Warm inspect pipeline for {tkey} did not respond - falling back to a cold run')
+
+	# Inspects only share the read lock, so each cold run gets files of its own
+	with PoolLock:
+		pool['count'] += 1
+		n = pool['count']
+	base = f'{tdir}/inspect-{tkey}-{g_nonce}-{n}'
+	env, pipe, files = inspect_pipe(test, base)
+	Path(f'{base}.sh').write_text(f"{env}cat '{base}.input' | {pipe} >/dev/null")
+	Path(f'{base}.input').write_text(input)
+	subprocess.run([timeout, str(timeout_sec), 'nice', '-n20', 'bash', f'{base}.sh'])
+
+	rv = {}
+	for k,fn in files.items():
+		rv[k] = Path(fn).read_text()
+	for fn in [f'{base}.sh', f'{base}.input'] + list(files.values()):
+		Path(fn).unlink(missing_ok=True)
 
 	return rv
 
@@ -403,6 +1162,8 @@ def do_cleanup(test):
 	# Find all managed files that currently exist
 	all = set()
 	all |= set(glob.glob(f'{g_root}/expected/{tkey}/*/expected-*.txt'))
+	all |= set(glob.glob(f'{g_root}/expected/{tkey}/*/expected-*.manifest'))
+	all |= set(glob.glob(f'{g_root}/expected/{tkey}/blobs.txt'))
 	all |= set(glob.glob(f'{g_root}/expected/{tkey}/*/gold-*.txt'))
 	for p in test['all_corpora'].values():
 		if '/local/' not in p:
@@ -412,9 +1173,16 @@ def do_cleanup(test):
 	keep = set()
 	for c,fn in test['all_corpora'].items():
 		keep.add(fn)
-		for s in test['steps'].keys():
-			keep.add(f'{g_root}/expected/{tkey}/{c}/expected-{c}-{s}.txt')
 		keep.add(f'{g_root}/expected/{tkey}/{c}/gold-{c}.txt')
+		# Corpora in the deduplicated store only keep their manifest, plain files next to it are just exports.
+		# With dedup switched off, the store is kept until cb_load() has exported the corpus.
+		man = f'{g_root}/expected/{tkey}/{c}/expected-{c}.manifest'
+		if os.path.exists(man) and (test['dedup'] or not os.path.exists(f'{g_root}/expected/{tkey}/{c}/expected-{c}-{next(iter(test["steps"]))}.txt')):
+			keep.add(man)
+			keep.add(f'{g_root}/expected/{tkey}/blobs.txt')
+		if not test['dedup'] or not os.path.exists(man):
+			for s in test['steps'].keys():
+				keep.add(f'{g_root}/expected/{tkey}/{c}/expected-{c}-{s}.txt')
 
 	# The difference is what we want to delete
 	rem = all - keep
@@ -424,24 +1192,138 @@ def do_cleanup(test):
 	for fn in rem:
 		print(f'Removing {fn}')
 		os.remove(fn)
-		if test['git']:
-			subprocess.run(['git', 'rm', '-f', '--cached', '--', fn], capture_output=True)
 
-	if add and test['git']:
-		subprocess.run(['git', 'add', '--'] + list(add))
+	if test['git']:
+		git_stage(test['test'], add, rem)
+
+def git_stage(tkey, add, rem):
+	# Only the last action on a path counts, so it moves between the sets
+	with GitLock:
+		pend = GitPending[tkey]
+		pend['add'] = (pend['add'] - rem) | add
+		pend['rm'] = (pend['rm'] - add) | rem
+		GitStatus[tkey]['state'] = 'pending'
+		GitStatus[tkey]['pending'] = len(pend['add']) + len(pend['rm'])
+
+		if tkey in GitTimers:
+			GitTimers[tkey].cancel()
+		GitTimers[tkey] = threading.Timer(git_delay_sec, git_flush, [tkey])
+		GitTimers[tkey].daemon = True
+		GitTimers[tkey].start()
+
+def git_flush(tkey):
+	# Runs without Locks[tkey], so accepts don't wait for git; GitRunLock keeps two batches from fighting over .git/index.lock
+	with GitRunLock:
+		with GitLock:
+			if tkey in GitTimers:
+				GitTimers.pop(tkey).cancel()
+			pend = GitPending.pop(tkey, None)
+			if not pend:
+				return
+			GitStatus[tkey]['state'] = 'staging'
+
+		err = ''
+		if pend['rm']:
+			run = subprocess.run(['git', 'rm', '-f', '-q', '--cached', '--ignore-unmatch', '--'] + sorted(pend['rm']), capture_output=True, encoding='UTF-8')
+			err += run.stderr
+		# Files may have been removed again by the time the batch runs, and git add fails on those
+		add = sorted(fn for fn in pend['add'] if os.path.exists(fn))
+		if add:
+			run = subprocess.run(['git', 'add', '--'] + add, capture_output=True, encoding='UTF-8')
+			err += run.stderr
+		if err:
+			print(err, end='')
+
+		with GitLock:
+			st = GitStatus[tkey]
+			st['staged'] = len(pend['add']) + len(pend['rm'])
+			st['error'] = err
+			st['time'] = time.time()
+			if tkey in GitPending:
+				st['pending'] = len(GitPending[tkey]['add']) + len(GitPending[tkey]['rm'])
+			else:
+				st['state'] = 'failed' if err else 'idle'
+				st['pending'] = 0
+
+def asset_get(fname):
+	# Static files are deflated once and kept, until their mtime or size changes
+	st = os.stat(fname)
+	with AssetLock:
+		a = Assets.get(fname)
+		if a and a['stat'] == (st.st_mtime_ns, st.st_size):
+			return a
+
+	data = Path(fname).read_bytes()
+	a = {
+		'stat': (st.st_mtime_ns, st.st_size),
+		'etag': '"%s"' % hashlib.sha1(data).hexdigest()[:20],
+		'mtime': int(st.st_mtime),
+		'blob': b''.join(compress([data], 9)),
+		}
+	with AssetLock:
+		Assets[fname] = a
+	return a
 
 def Get(params, p, df=''):
 	return params.get(p, [df])[0]
 
-def compress(s):
-	step = 2 << 17
-	producer = zlib.compressobj(level=9, wbits=15)
-	idx = 0
-	while idx < len(s):
-		yield producer.compress(s[idx:idx+step])
-		idx += step
+def lock_test(test, a, params):
+	# Takes Locks[tkey] shared for actions that only read state, and exclusive for the ones that change it; returns which it took
+	tkey = test['test']
+	if a in ['run', 'run-status']:
+		return ''
+	if a in ['inspect', 'git-status', 'search', 'timings']:
+		Locks[tkey].acquire_read()
+		return 'r'
+	if a == 'load':
+		corps = Get(params, 'c').split(',')
+		if not len(corps) or corps[0] == '' or corps[0] == '*':
+			corps = list(test['all_corpora'].keys())
+		# Loading a corpus into state is a change, and a finished run may have dropped the state while this waited
+		Locks[tkey].acquire_read()
+		if tkey in State and all(c in State[tkey]['corps'] for c in corps):
+			return 'r'
+		Locks[tkey].release_read()
+	Locks[tkey].acquire_write()
+	return 'w'
+
+def compress(chunks, level):
+	producer = zlib.compressobj(level=level, wbits=15)
+	for s in chunks:
+		yield producer.compress(s)
 	yield producer.flush()
 
+def json_chunks(obj, step=2 << 17, depth=3):
+	# Compact JSON in pieces of about step bytes; the outer containers are walked here, and anything below depth goes to the C encoder in one call
+	buf = []
+	n = 0
+	for s in json_walk(obj, depth):
+		buf.append(s)
+		n += len(s)
+		if n >= step:
+			yield ''.join(buf).encode('utf-8')
+			buf = []
+			n = 0
+	if buf:
+		yield ''.join(buf).encode('utf-8')
+
+def json_walk(obj, depth):
+	if depth and isinstance(obj, dict):
+		yield '{'
+		for i,(k,v) in enumerate(obj.items()):
+			yield (',' if i else '') + json.dumps(str(k), ensure_ascii=False) + ':'
+			yield from json_walk(v, depth-1)
+		yield '}'
+	elif depth and isinstance(obj, list):
+		yield '['
+		for i,v in enumerate(obj):
+			if i:
+				yield ','
+			yield from json_walk(v, depth-1)
+		yield ']'
+	else:
+		yield json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
 class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
 	protocol_version = 'HTTP/1.1'
 
@@ -468,9 +1350,14 @@ class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
 			self.end_headers()
 		elif m := re.match(r'^/(regtest|inspect)$', parts.path):
 			self.send_html(f'{g_dir}/static/{m[1]}.html')
+		elif (m := re.match(r'^/static/([-\w.]+)$', parts.path)) and os.path.isfile(f'{g_dir}/static/{m[1]}'):
+			self.send_asset(f'{g_dir}/static/{m[1]}', self.guess_type(m[1]))
 		elif parts.path.strip('/') == 'callback':
 			params = urllib.parse.parse_qs(parts.query)
 			self.do_callback(params)
+		elif parts.path.strip('/') == 'events':
+			params = urllib.parse.parse_qs(parts.query)
+			self.send_events(params)
 		else:
 			return super().do_GET()
 
@@ -479,28 +1366,94 @@ class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
 		data = self.rfile.read(ln)
 		self.do_callback(urllib.parse.parse_qs(data.decode('utf-8')))
 
-	def send_compressed(self, status, ctype, blob):
+	def send_compressed(self, status, ctype, chunks):
 		# based on https://github.com/PierreQuentel/httpcompressionserver/blob/master/httpcompressionserver.py (BSD license)
 		self.send_response(status)
 		self.send_header('Content-type', ctype)
 		self.send_header('Content-Encoding', 'deflate')
-		if len(blob) < (2 << 18):
+		chunks = iter(chunks)
+		first = next(chunks, b'')
+		second = next(chunks, None)
+		if second is None:
 			# don't bother chunking shorter messages
-			dt = b''.join(compress(blob))
+			dt = b''.join(compress([first], int(cmdargs.level)))
 			self.send_header('Content-Length', len(dt))
 			self.end_headers()
 			self.wfile.write(dt)
 		else:
+			# Pieces are compressed and sent as they are encoded, so the whole response is never held at once
 			self.send_header('Transfer-Encoding', 'chunked')
 			self.end_headers()
-			for data in compress(blob):
+			for data in compress(itertools.chain([first, second], chunks), int(cmdargs.level)):
 				if data:
 					ln = hex(len(data))[2:].upper().encode('utf-8')
 					self.wfile.write(ln + b'\r\n' + data + b'\r\n')
 			self.wfile.write(b'0\r\n\r\n')
 
+	def send_events(self, params):
+		# Server-Sent Events for a run job; EventSource reconnects with Last-Event-ID, so a dropped stream picks up where it left off
+		job = Jobs.get(Get(params, 'j'))
+		if not job or Get(params, 'n', g_nonce) != g_nonce:
+			resp = 'No such run'
+			self.send_response(HTTPStatus.NOT_FOUND)
+			self.send_header("Content-type", 'text/plain')
+			self.send_header("Content-Length", len(resp))
+			self.end_headers()
+			self.wfile.write(resp.encode('utf-8'))
+			return
+
+		self.close_connection = True
+		self.send_response(HTTPStatus.OK)
+		self.send_header('Content-type', 'text/event-stream')
+		self.send_header('Cache-Control', 'no-cache')
+		self.end_headers()
+
+		n = int(self.headers.get('Last-Event-ID', -1)) + 1
+		try:
+			while True:
+				with JobLock:
+					if n >= len(job['events']) and job['state'] == 'running':
+						JobLock.wait(event_ping_sec)
+					evs = job['events'][n:]
+					running = job['state'] == 'running'
+				if not evs and running:
+					self.wfile.write(b': ping\n\n')
+				for e in evs:
+					self.wfile.write(f'id: {n}\nevent: {e["type"]}\ndata: {json.dumps(e, ensure_ascii=False)}\n\n'.encode('utf-8'))
+					n += 1
+				self.wfile.flush()
+				if not running and n >= len(job['events']):
+					break
+		except (BrokenPipeError, ConnectionResetError):
+			pass
+
+	def send_asset(self, fname, ctype):
+		a = asset_get(fname)
+		fresh = False
+		if inm := self.headers.get('If-None-Match'):
+			fresh = inm.strip() == '*' or a['etag'] in [t.strip().removeprefix('W/') for t in inm.split(',')]
+		elif ims := self.headers.get('If-Modified-Since'):
+			try:
+				fresh = email.utils.parsedate_to_datetime(ims).timestamp() >= a['mtime']
+			except (TypeError, ValueError):
+				pass
+
+		self.send_response(HTTPStatus.NOT_MODIFIED if fresh else HTTPStatus.OK)
+		self.send_header('ETag', a['etag'])
+		self.send_header('Last-Modified', email.utils.formatdate(a['mtime'], usegmt=True))
+		# The pages don't version their asset URLs, so browsers have to check back, but a 304 is cheap
+		self.send_header('Cache-Control', 'no-cache')
+		if fresh:
+			self.end_headers()
+			return
+		self.send_header('Content-type', ctype)
+		self.send_header('Content-Encoding', 'deflate')
+		self.send_header('Content-Length', len(a['blob']))
+		self.end_headers()
+		self.wfile.write(a['blob'])
+
 	def send_html(self, fname):
-		self.send_compressed(HTTPStatus.OK, 'text/html', Path(fname).read_bytes())
+		self.send_asset(fname, 'text/html')
 
 	def do_callback(self, params):
 		if 'n' in params and Get(params, 'n') != g_nonce:
@@ -526,16 +1479,23 @@ class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
 
 		tkey = None
 		test = None
+		lock = ''
 		if 't' in params:
 			tkey = Get(params, 't')
 			if tkey not in Tests:
 				_, Tests[tkey] = Helpers.resolve_test(g_config, tkey)
-				Locks[tkey] = threading.Lock()
+				Locks[tkey] = RWLock()
+				RunLocks[tkey] = threading.Lock()
 			test = Tests[tkey]
-			Locks[tkey].acquire()
+			lock = lock_test(test, Get(params, 'a'), params)
+
+		# The runner rewrites the output files, so nothing may be read from them into state or the journal until it is done, while the init actions only resolve the config again
+		if lock == 'w' and tkey in Running and Get(params, 'a') not in ['init-regtest', 'init-inspect']:
+			status = HTTPStatus.CONFLICT
+			resp = {'error': 'A run of this test is in progress. Wait for it to finish, then reload the page.'}
 
 		# REGTEST
-		if Get(params, 'a') == 'init-regtest':
+		elif Get(params, 'a') == 'init-regtest':
 			resp['nonce'] = g_nonce
 			resp['test'] = test
 			resp['tests'] = []
@@ -551,16 +1511,52 @@ class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
 
 		elif Get(params, 'a') == 'load':
 			try:
-				resp = cb_load(test, Get(params, 'c').split(','), Get(params, 'g'), int(Get(params, 'p')), int(Get(params, 'z')))
+				resp = cb_load(test, Get(params, 'c').split(','), Get(params, 'g'), int(Get(params, 'p')), int(Get(params, 'z')), bool(Get(params, 'd')))
 			except Exception as e:
 				traceback.print_exception(e)
 				status = HTTPStatus.PRECONDITION_FAILED
 				resp = {'error': 'Current state is missing or invalid. You will need to run the regression test for all corpora. This can be done with the button at the top of the page, or by passing -r to regtest.py'}
 
 		elif Get(params, 'a') == 'run':
-			good, cmd = test_run(test, Get(params, 'c', '*').split(','))
-			resp['good'] = good
-			resp['cmd'] = cmd
+			job = job_start(test, Get(params, 'c', '*').split(','))
+			# Scripts can still ask to wait for the result, like before runs were jobs
+			if Get(params, 'w'):
+				with JobLock:
+					while job['state'] == 'running':
+						JobLock.wait()
+				resp['good'] = job['good']
+				resp['cmd'] = job['cmd']
+			resp['job'] = job_status(job)
+
+		elif Get(params, 'a') == 'run-status':
+			job = Jobs.get(Get(params, 'j'))
+			if not job:
+				# Without an id, the latest run of the test
+				with JobLock:
+					job = max((j for j in Jobs.values() if j['test'] == tkey), key=lambda j: j['started'], default=None)
+			if job:
+				resp['job'] = job_status(job)
+			else:
+				status = HTTPStatus.NOT_FOUND
+				resp['error'] = 'No such run'
+
+		elif Get(params, 'a') == 'search':
+			if tkey in Running:
+				status = HTTPStatus.CONFLICT
+				resp = {'error': 'A run of this test is in progress. Search again once it is done.'}
+			else:
+				try:
+					resp = cb_search(test, Get(params, 'q'), bool(Get(params, 'r')), Get(params, 'c').split(','), Get(params, 's').split(','), int(Get(params, 'p', 0)), int(Get(params, 'z', cmdargs.pagesize)))
+				except re.error as e:
+					status = HTTPStatus.BAD_REQUEST
+					resp = {'error': f'Invalid regex: {e}'}
+
+		elif Get(params, 'a') == 'timings':
+			if tkey in Running:
+				status = HTTPStatus.CONFLICT
+				resp = {'error': 'A run of this test is in progress. Ask for timings once it is done.'}
+			else:
+				resp = cb_timings(test, Get(params, 'c').split(','), Get(params, 's').split(','), int(Get(params, 'z', 20)))
 
 		elif Get(params, 'a') == 'accept-nd':
 			try:
@@ -592,6 +1588,10 @@ class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
 			cb_gold(test, hs, 'set', gs)
 			resp['hs'] = hs
 
+		elif Get(params, 'a') == 'git-status':
+			with GitLock:
+				resp['git'] = dict(GitStatus[tkey])
+
 		# INSPECT
 		elif Get(params, 'a') == 'init-inspect':
 			resp['nonce'] = g_nonce
@@ -600,6 +1600,8 @@ class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
 			for k,t in g_config['tests'].items():
 				resp['tests'].append([k, t['desc']])
 			test['steps'], test['all_steps'] = Helpers.resolve_steps(g_config, test)
+			# Start a pipeline now, so it has loaded by the time the first input arrives
+			pool_start(test)
 
 		elif Get(params, 'a') == 'inspect':
 			resp['output'] = do_inspect(test, Get(params, 'txt'))
@@ -607,27 +1609,53 @@ class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
 		else:
 			resp['error'] = 'Unknown value for parameter "a"'
 
-		rstr = json.dumps(resp, ensure_ascii=False, indent=1).encode('utf-8')
-		self.send_compressed(status, 'application/json', rstr)
+		self.send_compressed(status, 'application/json', json_chunks(resp))
 
-		if test:
-			Locks[tkey].release()
+		if lock == 'r':
+			Locks[tkey].release_read()
+		elif lock == 'w':
+			Locks[tkey].release_write()
 
 def start_server(port, page_size=250):
 	handle = partial(CallbackRequestHandler, directory=g_dir, page_size=page_size)
 	print('Starting server')
 	print('Open http://localhost:%d in your browser' % port)
 
+	for fn in glob.glob(f'{g_dir}/static/*'):
+		asset_get(fn)
+
 	with http.server.ThreadingHTTPServer(('', port), handle) as httpd:
 		try:
 			httpd.serve_forever()
 		except KeyboardInterrupt:
 			print('')
+			for tkey in list(Journaled.keys()):
+				journal_flush(Tests[tkey])
+			for tkey in list(GitPending.keys()):
+				git_flush(tkey)
+			if ScanPool:
+				ScanPool.shutdown(cancel_futures=True)
+			for pool in Pools.values():
+				for w in pool['idle']:
+					pool_stop(w)
 			# the exception raised by sys.exit() gets caught by the
 			# server, so we need to be a bit more drastic
 			os._exit(0)
 
-if cmdargs.run:
-	good, cmd = test_run(g_test, list(g_corps.keys()))
+# The scan pool's children import this file, and must not go on to start a server of their own
+if __name__ == '__main__':
+	if cmdargs.export:
+		g_test['steps'], g_test['all_steps'] = Helpers.resolve_steps(g_config, g_test)
+		g_test['all_corpora'] = Helpers.resolve_corps(g_root, g_config, g_test)
+		for c in g_corps.keys():
+			if os.path.exists(Helpers.store_paths(g_root, g_test, c)[1]):
+				print(f'Exporting {c}')
+				Helpers.export_expected(g_root, g_test, c)
+		sys.exit(0)
+
+	ScanPool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('forkserver'))
+
+	if cmdargs.run:
+		good, cmd = test_run(g_test, list(g_corps.keys()))
 
-start_server(int(cmdargs.port), int(cmdargs.pagesize))
+	start_server(int(cmdargs.port), int(cmdargs.pagesize))
@@ -1,39 +1,63 @@
 #!/usr/bin/env python3
 import argparse
-import base64
-import hashlib
+import concurrent.futures
+import glob
+import json
 import math
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import selectors
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
+from collections import OrderedDict, defaultdict
 from pathlib import Path
 
 import Helpers
 
-def hash(s):
-    return base64.b64encode(hashlib.sha1(s.encode('UTF-8')).digest(), b'xx').decode('UTF-8').rstrip('=')
-
 parser = argparse.ArgumentParser(prog='runner.py', description='Regression test runner')
 #parser.add_argument('-l', '--list', action='store_true', help='List usable tests and corpora')
 parser.add_argument('-P', '--proc', action='store', help='Number of parallel processes; defaults to max(3,num_cores/4)', default=int(max(3, os.cpu_count()/4)))
 parser.add_argument('-f', '--folder', action='store', help='Folder with regtest.json5; defaults to looking in ./, regtest/, or test/', default='')
 parser.add_argument('-c', '--corp', action='append', help='Restricts the test to the named corpora; can be given multiple times and/or pass a comma separated list', default=[])
+parser.add_argument('-b', '--batch', action='store', help='Number of inputs handed to a worker at a time; defaults to 10', default=10)
+parser.add_argument('-E', '--engine', action='store', choices=['bash', 'native'], help='How to run the pipe: bash runs generated scripts with timeout and tee around every step, native starts the steps directly and captures their output in-process; defaults to bash', default='bash')
+parser.add_argument('-W', '--watchdog', action='store', help='Seconds a worker may go without finishing an input before that input is recorded as timed out and the worker is restarted on the inputs after it; 0 disables; defaults to 300', default=300)
+parser.add_argument('-C', '--no-cache', action='store_true', help='Run all inputs through the pipe, ignoring and not updating the result cache', default=False)
+parser.add_argument('-T', '--timings', action='store', help='Write the seconds spent in each phase of the run to this file as JSON', default='')
 parser.add_argument('-D', '--debug', action='store_true', help='Enable Python stack traces and other debugging', default=False)
 parser.add_argument('test', nargs='?', help='Which test to run; defaults to first defined', default='')
 args = parser.parse_args()
 
+phases = {}
+phase_at = time.time()
+
+def phase(name):
+	# Seconds since the previous phase ended, for -T
+	global phase_at
+	now = time.time()
+	phases[name] = now - phase_at
+	phase_at = now
+
 if not args.debug:
 	sys.tracebacklimit = 0
 
 root = Helpers.find_root(args.folder)
 
 procs = int(args.proc)
+batch_size = max(1, int(args.batch))
 
 timeout = Helpers.timeout()
 timeout_sec = 1800 # Half an hour
+watchdog_sec = float(args.watchdog)
+kill_grace_sec = 5 # Steps get this long to exit on SIGTERM before the worker is sent SIGKILL
+cache_keep = 3 # Pipe fingerprints to keep cached results for, so toggling back and forth between grammar versions stays cheap
 
 config = Helpers.load_config(root)
 
@@ -55,22 +79,45 @@ shutil.rmtree(f'{root}/output/{tkey}/_tmp', ignore_errors=True)
 os.makedirs(f'{root}/output/{tkey}/_tmp/', exist_ok=True)
 Path(f'{root}/output/{tkey}/_tmp/lock').write_text(str(os.getpid()))
 
-steps, _ = Helpers.resolve_steps(config, test)
-
-pipe = ''
-for p,s in steps.items():
-	# Every step gets its own timeout watcher, to avoid runaway background processes
-	pipe += f' | {timeout} {timeout_sec} {s["cmd"]}'
-	if 'trace' in s:
-		pipe += f' {s["trace"]} 2>{root}/output/{tkey}/_tmp/step-{p}.NNN.err | tee {root}/output/{tkey}/_tmp/step-{p}.trace.NNN'
-	elif s['type'] == 'cg':
-		pipe += f' --trace 2>{root}/output/{tkey}/_tmp/step-{p}.NNN.err | cg-sort | tee {root}/output/{tkey}/_tmp/step-{p}.trace.NNN | cg-untrace | cg-sort'
-	else:
-		pipe += f' 2>{root}/output/{tkey}/_tmp/step-{p}.NNN.err'
-	pipe += f' | tee {root}/output/{tkey}/_tmp/step-{p}.NNN'
-pipe = pipe.replace(' --trace --trace ', ' --trace ')
-pipe = pipe.replace(' cg3-autobin.pl ', ' vislcg3 ')
-pipe = pipe[3:]
+steps, all_steps = Helpers.resolve_steps(config, test)
+fps = Helpers.step_fingerprints(steps, test['env'])
+cache = f'{root}/output/{tkey}/_cache'
+
+tmp = f'{root}/output/{tkey}/_tmp'
+
+def make_pipe(start):
+	pipe = ''
+	for p,s in list(steps.items())[start:]:
+		# Every step gets its own timeout watcher, to avoid runaway background processes
+		pipe += f' | {timeout} {timeout_sec} {s["cmd"]}'
+		if 'trace' in s:
+			pipe += f' {s["trace"]} 2>{tmp}/step-{p}.NNN.err | tee {tmp}/step-{p}.trace.NNN'
+		elif s['type'] == 'cg':
+			pipe += f' --trace 2>{tmp}/step-{p}.NNN.err | cg-sort | tee {tmp}/step-{p}.trace.NNN | cg-untrace | cg-sort'
+		else:
+			pipe += f' 2>{tmp}/step-{p}.NNN.err'
+		pipe += f' | tee {tmp}/step-{p}.NNN'
+	pipe = pipe.replace(' --trace --trace ', ' --trace ')
+	pipe = pipe.replace(' cg3-autobin.pl ', ' vislcg3 ')
+	return pipe[3:]
+
+def make_chain(start):
+	# Same processes as make_pipe(), minus timeout and tee - each entry lists the outputs that are captured from its stdout
+	chain = []
+	for p,s in list(steps.items())[start:]:
+		cmd = f' {s["cmd"]} '.replace(' cg3-autobin.pl ', ' vislcg3 ').strip()
+		err = f'{tmp}/step-{p}.NNN.err'
+		if 'trace' in s:
+			chain.append({'cmd': f'{cmd} {s["trace"]}', 'err': err, 'taps': [f'{p}-trace', p]})
+		elif s['type'] == 'cg':
+			cmd = f' {cmd} --trace '.replace(' --trace --trace ', ' --trace ').strip()
+			chain.append({'cmd': cmd, 'err': err, 'taps': []})
+			chain.append({'cmd': 'cg-sort', 'err': None, 'taps': [f'{p}-trace']})
+			chain.append({'cmd': 'cg-untrace', 'err': None, 'taps': []})
+			chain.append({'cmd': 'cg-sort', 'err': None, 'taps': [p]})
+		else:
+			chain.append({'cmd': cmd, 'err': err, 'taps': [p]})
+	return chain
 
 inputs = {}
 uniq_inputs = {}
@@ -107,129 +154,678 @@ for c,f in corps.items():
 			if not l or l == '':
 				continue
 
-			h = hash(l)
+			h = Helpers.hash(l)
 			if h not in inputs[c]:
 				inputs[c][h] = start
 			if h not in uniq_inputs:
 				uniq_inputs[h] = l
 
-# Just in case there are fewer inputs than CPU cores
-procs = min(procs, len(uniq_inputs))
+# Each step's fingerprint covers all steps before it, so an input can resume right after the last step that has its output cached
+depth = dict.fromkeys(uniq_inputs.keys(), 0)
+if not args.no_cache:
+	alive = set(uniq_inputs.keys())
+	for n,p in enumerate(steps.keys()):
+		fn = f'{cache}/step-{p}/{fps[p]}.ids'
+		if not os.path.exists(fn):
+			break
+		alive &= set(Path(fn).read_text(encoding='UTF-8').split())
+		for k in alive:
+			depth[k] = n+1
+
+groups = defaultdict(list)
+for k in sorted(uniq_inputs.keys()):
+	if depth[k] < len(steps):
+		groups[depth[k]].append(k)
+todo = sum(len(ids) for ids in groups.values())
 
 for c,hs in inputs.items():
 	with open(f'{root}/output/{tkey}/corp-{c}.ids', 'w', encoding='UTF-8') as fd:
 		for k,v in hs.items():
 			fd.write(f'{k}\t{v}\n')
 
-fds = []
-for i in range(procs):
-	fds.append(open(f'{root}/output/{tkey}/_tmp/input.{i}', 'w', encoding='UTF-8'))
-
-chunk = int(len(uniq_inputs)/procs)+1
-for i,k in enumerate(sorted(uniq_inputs.keys())):
+def wrap_input(k):
 	t = uniq_inputs[k]
 	if t.startswith('<s'):
 		t = re.sub(r'^<s', f'<s id="{k}"', t)
 	else:
 		t = f'<s id="{k}">\n{t}\n</s>'
-	fds[min(int(math.floor(i/chunk)), procs-1)].write(f'{t}\n\n<STREAMCMD:FLUSH>\n\n')
+	return f'{t}\n\n<STREAMCMD:FLUSH>\n\n'
 
-bash = ''
-for e in test['env']:
-	bash += f'export "{e}"\n'
+def cache_files(p, s):
+	rv = [(f'step-{p}', f'{cache}/step-{p}/{fps[p]}')]
+	if 'trace' in s or s['type'] == 'cg':
+		rv.append((f'step-{p}.trace', f'{cache}/step-{p}/{fps[p]}.trace'))
+	return rv
 
-outs = []
-for i in range(procs):
-	fds[i].close()
-	np = re.sub(r'\.NNN', f'.{i}', pipe)
-	Path(f'{root}/output/{tkey}/_tmp/sh.{i}').write_text(np)
-	# Race prevention: Create and open the output files for reading, so the script can append to existing files
-	Path(f'{root}/output/{tkey}/_tmp/out.{i}').touch()
-	outs.append(open(f'{root}/output/{tkey}/_tmp/out.{i}', 'r', encoding='UTF-8'))
-	bash += f'cat {root}/output/{tkey}/_tmp/input.{i} | bash {root}/output/{tkey}/_tmp/sh.{i} >>{root}/output/{tkey}/_tmp/out.{i} 2>{root}/output/{tkey}/_tmp/err.{i} &\n'
-
-bash += f'''
-for job in `jobs -p`
-do
-	#echo "Waiting for $job"
-	wait $job
-done
-
-echo "Done" > {root}/output/{tkey}/_tmp/done
-'''
-
-Path(f'{root}/output/{tkey}/_tmp/sh').write_text(bash)
-seen = set()
-proc = subprocess.Popen([timeout, str(timeout_sec), 'nice', '-n20', 'bash', f'{root}/output/{tkey}/_tmp/sh'])
+phase('parse')
 
-print('Running: %s -P %s -f %s -c %s %s' % (os.path.relpath(__file__), str(procs), root, ','.join(sorted(corps.keys())), tkey))
-print('Progress: 0%', end='\r', flush=True)
-while not proc.poll():
-	time.sleep(1)
-	did = False
-	for i in range(procs):
-		while l := outs[i].readline():
-			if m := re.search(r'^<s id="([^"]+)"', l):
-				seen.add(m[1])
-				did = True
-	if did:
-		print('Progress: {}%'.format(int(len(seen) / len(uniq_inputs) * 100)), end='\r', flush=True)
-
-	if os.path.exists(f'{root}/output/{tkey}/_tmp/done'):
-		break
-
-print('Progress: 100%', end='\r', flush=True)
-
-for i in range(procs):
-	outs[i].close()
+with open(f'{tmp}/input.all', 'w', encoding='UTF-8') as fd:
+	for k in sorted(uniq_inputs.keys()):
+		fd.write(wrap_input(k))
 
-if len(seen) != len(uniq_inputs):
-	# Check again, because sometimes the above loop skips an ID
-	seen = set()
-	for i in range(procs):
-		seen |= set(re.findall(r'(?:^|\n)<s id="([^"]+)"', Path(f'{root}/output/{tkey}/_tmp/out.{i}').read_text()))
-	if len(seen) != len(uniq_inputs):
-		missing = set(uniq_inputs.keys()) - set(seen)
-		print('Warning: Missing outputs - got {0} of {1}! Example missing ID: {2}'.format(len(seen), len(uniq_inputs), list(missing)[0]))
+# Copy out cached step outputs, and use the last cached step's output as input for the first step that must run
+feeds = {}
+max_depth = max(depth.values(), default=0)
+for n,(p,s) in enumerate(steps.items()):
+	if n >= max_depth:
+		break
+	for f,cf in cache_files(p, s):
+		with open(f'{tmp}/{f}.cache', 'w', encoding='UTF-8') as fd:
+			for id,b in Helpers.read_segments(f'{cf}.txt'):
+				if depth.get(id, 0) <= n:
+					continue
+				fd.write(b + '\n')
+				if f == f'step-{p}' and depth[id] == n+1 and n+1 < len(steps):
+					feeds[id] = f'{b}\n<STREAMCMD:FLUSH>\n\n'
 
 for c in inputs.keys():
 	shutil.rmtree(f'{root}/output/{tkey}/{c}', ignore_errors=True)
 	os.makedirs(f'{root}/output/{tkey}/{c}/', exist_ok=True)
 
-def split_to_corps(s, f):
-	global procs, inputs, root, test
+# Which corpora each input occurs in, so splitting output needn't ask every corpus about every input
+id_corps = defaultdict(list)
+for c,hs in inputs.items():
+	for h in hs.keys():
+		id_corps[h].append(c)
 
-	cfs = {}
-	for c in inputs.keys():
-		cfs[c] = open(f'{root}/output/{tkey}/{c}/output-{c}-{s}.txt', 'w')
-
-	for i in range(procs):
-		with open(f'{f}.{i}', 'r', encoding='UTF-8') as fd:
-			while l := fd.readline():
-				if l.startswith('<s '):
-					while e := fd.readline():
-						l += e
-						if e.startswith('</s>'):
-							break
-					l = re.sub(r'[ \t]+\n', '\n', l)
-					l = re.sub(r'\n\n\n+', '\n\n', l)
-					m = re.search(r'^<s id="([^"]+)"', l)
-					for c in inputs.keys():
-						if m[1] in inputs[c]:
-							cfs[c].write(l + '\n')
+re_trailing_ws = re.compile(r'[ \t]+\n')
+re_blank_lines = re.compile(r'\n\n\n+')
 
-	for c in inputs.keys():
-		cfs[c].close()
+parts = []
+seen = set()
+# Seconds each step spent on each input, by step and id
+times = {p: {} for p in steps.keys()}
+# Inputs the watchdog gave up on, with the step each got stuck in
+timeouts = {}
+# Remembered across runs of the same pipe, so a rerun of only the inputs that hung can still be watched
+last_step = list(steps.keys())[-1]
+stream_flag = f'{cache}/step-{last_step}/{fps[last_step]}.streams'
+streams = not args.no_cache and os.path.exists(stream_flag)
+# What this run has seen for itself, which outranks the flag
+streamed = False
+buffered = False
+
+def feed_worker(w, q, cond):
+	try:
+		while True:
+			try:
+				batch = q.get_nowait()
+			except queue.Empty:
+				break
+			with cond:
+				# Keep the pipe primed without letting one worker hoard inputs, but steps that buffer their output
+				# don't show progress until enough input has gone in, so widen the window whenever the worker stalls
+				while not cond.wait_for(lambda: w['sent'] - w['done'] < w['window'] or w['proc'].poll() is not None, timeout=1):
+					# Once the pipe is known to stream, a stall is a slow input, and the other workers should take the batches
+					if not (w['streams'] or streamed):
+						w['window'] *= 2
+						w['buffered'] = True
+			if w['proc'].poll() is not None:
+				# Worker died, so let the others steal its work
+				q.put(batch)
+				break
+			now = time.time()
+			with cond:
+				for k,t in batch:
+					w['at'][k] = now
+					w['pending'][k] = (t, now)
+			w['proc'].stdin.write(''.join(t for _,t in batch))
+			w['proc'].stdin.flush()
+			w['sent'] += len(batch)
+	except BrokenPipeError:
+		pass
+	finally:
+		w['fed'] = True
+		try:
+			w['proc'].stdin.close()
+		except BrokenPipeError:
+			pass
+
+def count_lines(f, data):
+	# Only act on complete lines - the rest of a partial line arrives with the next read
+	lines = (f['buf'] + data).split(b'\n')
+	f['buf'] = lines.pop()
+	for l in lines:
+		if l.startswith(b'<s id="'):
+			f['ids'] += 1
+			f['cur'] = l[7:l.index(b'"', 7)].decode('UTF-8')
+		elif l.startswith(b'</s>') and f.get('cur'):
+			# An input has only left the step once its segment is closed
+			yield f['cur']
+			f['cur'] = None
+		elif l.startswith(b'<STREAMCMD:FLUSH>'):
+			f['flushes'] += 1
+
+def input_done(w, id):
+	# Inputs finish in the order they were sent, so any still pending before this one were dropped by some step
+	with w['cond']:
+		if id in w['pending']:
+			while w['pending'].popitem(last=False)[0] != id:
+				pass
+	w['last'] = time.time()
+	# Output before the input has ended shows that the pipe flushes, rather than holding everything until it sees EOF
+	if not w['fed']:
+		w['streams'] = True
+
+def input_stuck(w, now):
+	# The oldest pending input, if the worker has been on it for longer than the watchdog allows
+	with w['cond']:
+		if not w['pending']:
+			return None, 0
+		id, (_, sent) = next(iter(w['pending'].items()))
+	stall = now - max(w['last'], sent)
+	if stall > watchdog_sec:
+		return id, stall
+	return None, 0
+
+def kill_worker(w, sig):
+	# Steps wrapped in timeout run in process groups of their own, so the worker's whole process tree is looked up and signalled.
+	# That is done once, as orphans are adopted away from the tree, and a SIGKILL after the grace period must still reach them.
+	if 'pids' not in w:
+		kids = defaultdict(list)
+		ps = subprocess.run(['ps', '-A', '-o', 'pid=,ppid='], capture_output=True, encoding='UTF-8').stdout
+		for l in ps.splitlines():
+			pid, ppid = l.split()
+			kids[int(ppid)].append(int(pid))
+		w['pids'] = []
+		todo = [proc.pid for proc in w['procs']]
+		while todo:
+			pid = todo.pop()
+			w['pids'].append(pid)
+			todo += kids[pid]
+	for pid in w['pids']:
+		try:
+			os.kill(pid, sig)
+		except ProcessLookupError:
+			pass
+
+def drop_partial(fn):
+	# A killed step can leave its last segment half written, which must not be taken for its output
+	with open(fn, 'rb+') as fd:
+		n = 0
+		if os.fstat(fd.fileno()).st_size:
+			with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+				if (n := mm.rfind(b'\n</s>')) >= 0:
+					n = mm.find(b'\n', n+1) + 1 or len(mm)
+		fd.truncate(max(n, 0))
+
+def step_left(w, p, id):
+	# A step works through its inputs in order, so its time on an input starts once both that input has arrived and the previous one has left
+	now = time.time()
+	times[p][id] = now - max(w['at'].get(id, now), w['left'].get(p, 0))
+	w['at'][id] = now
+	w['left'][p] = now
+
+def tap_feed(t, data):
+	lines = (t['buf'] + data).split(b'\n')
+	t['buf'] = lines.pop()
+	for l in lines:
+		if t['block'] is None:
+			if l.startswith(b'<s '):
+				t['block'] = [l]
+			continue
+		t['block'].append(l)
+		if l.startswith(b'</s>'):
+			b = b'\n'.join(t['block']).decode('UTF-8') + '\n'
+			t['block'] = None
+			if m := re.match(r'<s id="([^"]+)"', b):
+				t['ids'] += 1
+				t['raw'].write(b + '\n')
+				if t['out'] in times:
+					step_left(t['w'], t['out'], m[1])
+
+def relay(src, dst, taps):
+	try:
+		while data := os.read(src.fileno(), 2 << 16):
+			for t in taps:
+				tap_feed(t, data)
+			dst.write(data)
+			dst.flush()
+	except BrokenPipeError:
+		pass
+	finally:
+		src.close()
+		try:
+			dst.close()
+		except BrokenPipeError:
+			pass
+
+def start_native(w, i, start):
+	env = os.environ.copy()
+	for e in test['env']:
+		# Like export "NAME" in the bash engine, a name without a value only keeps what is already set
+		if '=' not in e:
+			continue
+		k, v = e.split('=', 1)
+		env[k] = os.path.expandvars(v)
+
+	taps = {}
+	for f in w['steps']:
+		taps[f['step']] = f
+		f['raw'] = f'{tmp}/step-{f["step"]}.{i}'
+	for p,s in list(steps.items())[start:]:
+		if 'trace' in s or s['type'] == 'cg':
+			taps[f'{p}-trace'] = {'step': f'{p}-trace', 'fn': None, 'raw': f'{tmp}/step-{p}.trace.{i}'}
+	for k,t in taps.items():
+		t.update({'out': k, 'buf': b'', 'block': None, 'ids': 0, 'w': w})
+		t['raw'] = open(t['raw'], 'w', encoding='UTF-8')
+
+	w['procs'] = []
+	w['relays'] = []
+	prev = None
+	with open(f'{tmp}/err.{i}', 'w', encoding='UTF-8') as err:
+		for n,st in enumerate(make_chain(start)):
+			stdin = subprocess.PIPE
+			if prev and not prev['taps']:
+				stdin = w['procs'][-1].stdout
+			serr = err
+			if st['err']:
+				serr = open(st['err'].replace('.NNN', f'.{i}'), 'w', encoding='UTF-8')
+			# Niced the same way as the bash engine's scripts, as preexec_fn isn't safe once the feeder and reader threads run
+			proc = subprocess.Popen(['nice', '-n20', '/bin/sh', '-c', st['cmd']], stdin=stdin, stdout=subprocess.PIPE, stderr=serr, env=env, encoding=('UTF-8' if n == 0 else None))
+			if st['err']:
+				serr.close()
+			if prev and prev['taps']:
+				w['relays'].append(threading.Thread(target=relay, args=(w['procs'][-1].stdout, proc.stdin, [taps[k] for k in prev['taps']]), daemon=True))
+			elif prev:
+				w['procs'][-1].stdout.close()
+			w['procs'].append(proc)
+			prev = st
+
+	for r in w['relays']:
+		r.start()
+	w['proc'] = w['procs'][0]
+	w['stdout'] = w['procs'][-1].stdout
+	w['taps'] = [taps[k] for k in prev['taps']]
+	w['all_taps'] = list(taps.values())
+
+def read_worker(w, data):
+	w['out'].write(data)
+	for t in w['taps']:
+		tap_feed(t, data)
+	for id in count_lines(w, data):
+		seen.add(id)
+		input_done(w, id)
+	# Some steps drop unknown stream commands, and some drop broken sentences, so count whichever gets further
+	w['done'] = max(w['ids'], w['flushes'])
+
+def read_steps(w):
+	for f in w['steps']:
+		if not f['fn']:
+			continue
+		if not f['fd']:
+			if not os.path.exists(f['fn']):
+				continue
+			f['fd'] = open(f['fn'], 'rb')
+		for id in count_lines(f, f['fd'].read()):
+			step_left(w, f['step'], id)
+
+def fmt_rate(n, secs):
+	return '{:.1f}/s'.format(n / max(secs, 0.001))
+
+def fmt_secs(secs):
+	secs = int(secs)
+	return '{}:{:02d}:{:02d}'.format(secs // 3600, secs // 60 % 60, secs % 60)
+
+def print_progress():
+	secs = time.time() - started
+	line = 'Progress: {}% ({} of {}'.format(int(len(seen) / todo * 100), len(seen), todo)
+	if seen:
+		line += ', {}, ETA {}'.format(fmt_rate(len(seen), secs), fmt_secs((todo - len(seen)) * secs / len(seen)))
+	print(line + ')    ', end='\r', flush=True)
 
-split_to_corps('010', f'{root}/output/{tkey}/_tmp/input')
+def start_worker(i, start, pipe, q, cond):
+	env = ''
+	for e in test['env']:
+		env += f'export "{e}"\n'
 
+	np = re.sub(r'\.NNN', f'.{i}', pipe)
+	Path(f'{tmp}/sh.{i}').write_text(env + np)
+	w = {
+		'part': i,
+		'start': start,
+		'out': open(f'{tmp}/out.{i}', 'wb'),
+		'buf': b'',
+		'sent': 0,
+		'done': 0,
+		'window': batch_size*2,
+		'ids': 0,
+		'flushes': 0,
+		'steps': [],
+		'at': {},
+		'left': {},
+		'cond': cond,
+		'pending': OrderedDict(),
+		'last': time.time(),
+		'fed': False,
+		'streams': False,
+		'buffered': False,
+		'eof': False,
+		'hung': None,
+		'closed': False,
+		}
+	if args.engine == 'native':
+		for p in list(steps.keys())[start:]:
+			w['steps'].append({'step': p, 'fn': None})
+		start_native(w, i, start)
+	else:
+		for p in list(steps.keys())[start:]:
+			w['steps'].append({'step': p, 'fn': f'{tmp}/step-{p}.{i}', 'fd': None, 'buf': b'', 'ids': 0, 'flushes': 0})
+		with open(f'{tmp}/err.{i}', 'w', encoding='UTF-8') as err:
+			w['proc'] = subprocess.Popen([timeout, str(timeout_sec), 'nice', '-n20', 'bash', f'{tmp}/sh.{i}'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=err, encoding='UTF-8')
+		w['procs'] = [w['proc']]
+		w['relays'] = []
+		w['stdout'] = w['proc'].stdout
+		w['taps'] = []
+	w['feeder'] = threading.Thread(target=feed_worker, args=(w, q, cond), daemon=True)
+	w['feeder'].start()
+	return w
+
+def finish_worker(w):
+	for proc in w['procs']:
+		proc.wait()
+	w['feeder'].join()
+	for r in w['relays']:
+		r.join()
+	w['out'].close()
+	read_steps(w)
+	for t in w.get('all_taps', []):
+		t['raw'].close()
+	for f in w['steps']:
+		if f.get('fd'):
+			f['fd'].close()
+	w['closed'] = True
+
+def restart_worker(w, q):
+	# Called once a killed worker's output has been read to the end; returns whether there is work left for a replacement
+	finish_worker(w)
+	id = w['hung']
+	with w['cond']:
+		stuck = id in w['pending']
+	if stuck:
+		ps = list(steps.keys())[w['start']:]
+		# It got stuck in the first step it never left
+		p = next((p for p in ps if id not in times[p]), ps[-1])
+		times[p][id] = w['stall']
+		timeouts[id] = p
+	for p,s in list(steps.items())[w['start']:]:
+		for f,_ in cache_files(p, s):
+			if os.path.exists(f'{tmp}/{f}.{w["part"]}'):
+				drop_partial(f'{tmp}/{f}.{w["part"]}')
+
+	# Everything else it had been sent starts over on a fresh worker
+	with w['cond']:
+		rest = [(k, t) for k,(t,_) in w['pending'].items() if k != id]
+	for i in range(0, len(rest), batch_size):
+		q.put(rest[i:i+batch_size])
+	return not q.empty()
+
+def run_group(start, ids):
+	global parts, seen, streams, streamed, buffered
+
+	gprocs = min(procs, math.ceil(len(ids)/batch_size))
+	gparts = [f'{start}-{i}' for i in range(gprocs)]
+	parts += gparts
+	pipe = make_pipe(start)
+	gstarted = time.time()
+
+	q = queue.Queue()
+	for i in range(0, len(ids), batch_size):
+		if start:
+			q.put([(k, feeds[k]) for k in ids[i:i+batch_size]])
+		else:
+			q.put([(k, wrap_input(k)) for k in ids[i:i+batch_size]])
+
+	ws = []
+	cond = threading.Condition()
+	sel = selectors.DefaultSelector()
+	for i in gparts:
+		w = start_worker(i, start, pipe, q, cond)
+		sel.register(w['stdout'], selectors.EVENT_READ, w)
+		ws.append(w)
+
+	# Wake up on worker output, and at least ten times a second to read the step outputs
+	running = len(ws)
+	killed = False
+	while running:
+		for key,_ in sel.select(timeout=0.1):
+			w = key.data
+			data = os.read(key.fd, 2 << 16)
+			if data:
+				read_worker(w, data)
+				with cond:
+					cond.notify_all()
+				continue
+			sel.unregister(key.fileobj)
+			w['eof'] = True
+			running -= 1
+			if w['hung'] and restart_worker(w, q):
+				i = f'{start}-{len(gparts)}'
+				gparts.append(i)
+				parts.append(i)
+				w = start_worker(i, start, pipe, q, cond)
+				sel.register(w['stdout'], selectors.EVENT_READ, w)
+				ws.append(w)
+				running += 1
+
+		now = time.time()
+		if args.engine == 'native' and now - gstarted > timeout_sec and not killed:
+			# The bash engine has timeout watchers for this
+			print(f'Timed out after {timeout_sec} seconds - killing workers')
+			killed = True
+			for w in ws:
+				for proc in w['procs']:
+					proc.kill()
+		# A pipe that doesn't flush is silent until its input ends, so the watchdog only runs once the pipe has been seen to stream,
+		# and not once a worker has stalled with nothing out before its input ended while no other worker streamed
+		streamed = streamed or any(w['streams'] for w in ws)
+		buffered = buffered or any(w['buffered'] and not w['streams'] for w in ws)
+		streams = streamed or (streams and not buffered)
+		if watchdog_sec and streams:
+			for w in ws:
+				if w['eof']:
+					continue
+				if w['hung']:
+					if now - w['hung_at'] > kill_grace_sec and not w.get('hard'):
+						w['hard'] = True
+						kill_worker(w, signal.SIGKILL)
+					continue
+				id, stall = input_stuck(w, now)
+				if id:
+					print(f'Worker {w["part"]} has been on input {id} for {int(stall)} seconds - restarting it without that input')
+					w['hung'] = id
+					w['hung_at'] = now
+					w['stall'] = stall
+					kill_worker(w, signal.SIGTERM)
+		# With the bash engine, step outputs are only seen when read here, which bounds how finely inputs are timed
+		for w in ws:
+			if not w['closed']:
+				read_steps(w)
+		if now - stats['shown'] >= 0.25:
+			stats['shown'] = now
+			print_progress()
+
+	sel.close()
+	with cond:
+		cond.notify_all()
+
+	secs = time.time() - gstarted
+	for w in ws:
+		if not w['closed']:
+			finish_worker(w)
+		stats['workers'][w['part']] = fmt_rate(w['ids'], secs)
+		for f in w['steps']:
+			stats['steps'][f['step']][0] += f['ids']
+
+phase('prepare')
+print('Running: %s -P %s -f %s -c %s %s' % (os.path.relpath(__file__), str(procs), root, ','.join(sorted(corps.keys())), tkey))
+if todo != len(uniq_inputs):
+	print(f'Cached: {len(uniq_inputs) - todo} of {len(uniq_inputs)} inputs')
+for start,ids in sorted(groups.items()):
+	if start:
+		print(f'Resuming {len(ids)} inputs from step {list(steps.keys())[start]}')
+
+stats = {
+	'shown': 0,
+	'workers': {},
+	'steps': defaultdict(lambda: [0, 0.0]),
+	}
+started = time.time()
+if todo:
+	print_progress()
+	for start,ids in sorted(groups.items()):
+		run_group(start, ids)
+	print_progress()
+	print('')
+	# Each step's rate is over the time it was busy with inputs, summed over the workers, so slow steps stand out from fast ones
+	for p,st in stats['steps'].items():
+		st[1] = sum(times[p].values())
+	print('Steps: ' + ', '.join(f'{p} {fmt_rate(n, secs)}' for p,(n,secs) in stats['steps'].items()))
+	print('Workers: ' + ', '.join(f'{i} {r}' for i,r in stats['workers'].items()))
+	print('Run took {}'.format(fmt_secs(time.time() - started)))
+
+phase('run')
+
+if timeouts:
+	print('Warning: Timed out on {0} inputs after {1} seconds: {2}'.format(len(timeouts), int(watchdog_sec), ', '.join(f'{k} in {p}' for k,p in list(timeouts.items())[:5])))
+if len(seen) + len(timeouts) != todo:
+	missing = set(k for ids in groups.values() for k in ids) - set(seen) - set(timeouts)
+	print('Warning: Missing outputs - got {0} of {1}! Example missing ID: {2}'.format(len(seen), todo, list(missing)[0]))
+
+# Timed out inputs only have output up to the step they got stuck in, which regtest.py shows as their own category
+for c,hs in inputs.items():
+	with open(f'{root}/output/{tkey}/corp-{c}.timeouts', 'w', encoding='UTF-8') as fd:
+		for k,p in timeouts.items():
+			if k in hs:
+				fd.write(f'{k}\t{p}\t{times[p][k]:.6f}\n')
+
+def read_times(fn):
+	rv = {}
+	if os.path.exists(fn):
+		with open(fn, 'r', encoding='UTF-8') as fd:
+			for l in fd:
+				id, t = l.rstrip('\n').split('\t')
+				rv[id] = float(t)
+	return rv
+
+# Inputs that resumed from the cache report the times from when they last ran
+if not args.no_cache:
+	for n,p in enumerate(steps.keys()):
+		for id,t in read_times(f'{cache}/step-{p}/{fps[p]}.times').items():
+			if depth.get(id, 0) > n:
+				times[p].setdefault(id, t)
+
+for c,hs in inputs.items():
+	with open(f'{root}/output/{tkey}/corp-{c}.times', 'w', encoding='UTF-8') as fd:
+		for p,ts in times.items():
+			for k in hs.keys():
+				if k in ts:
+					fd.write(f'{k}\t{p}\t{ts[k]:.6f}\n')
+
+def split_to_corps(s, fs):
+	# Runs in its own process, which has all of the per-corpus files for this step to itself
+	where = {}
+	mms = []
+	for f in fs:
+		if not os.path.exists(f) or not os.path.getsize(f):
+			continue
+		with open(f, 'rb') as fd:
+			mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+		mms.append(mm)
+		for id,_,_,a,b in Helpers.scan_segments(f):
+			# Inputs a restarted worker was still on are run again, so the first complete copy wins
+			if id not in where and mm.rfind(b'\n</s>', a, b) >= 0:
+				where[id] = (mm, a, b)
+
+	cfs = {}
+	for c in inputs.keys():
+		cfs[c] = open(f'{root}/output/{tkey}/{c}/output-{c}-{s}.txt', 'w', encoding='UTF-8', buffering=2 << 20)
+
+	# Workers finish inputs in no set order, so segments are written sorted by id, which keeps the files, and expected files copied from them, the same from run to run
+	for id in sorted(where.keys()):
+		mm, a, b = where[id]
+		l = mm[a:b].decode('UTF-8')
+		l = re_trailing_ws.sub('\n', l)
+		l = re_blank_lines.sub('\n\n', l)
+		for c in id_corps.get(id, ()):
+			cfs[c].write(l + '\n')
+	for mm in mms:
+		mm.close()
+
+	# The index also carries each segment's digest, which is all regtest.py needs to classify changes
+	for c,f in cfs.items():
+		f.close()
+		Helpers.build_index(f.name, Helpers.index_path(root, tkey, f.name))
+
+split_parts = parts + ['cache']
+
+jobs = [('010', [f'{tmp}/input.all'])]
 for p,s in steps.items():
-	t = 'auto'
-	if 'type' in s:
-		t = s['type']
-	if 'trace' in s or t == 'cg':
-		split_to_corps(f'{p}-trace', f'{root}/output/{tkey}/_tmp/step-{p}.trace')
-	split_to_corps(p, f'{root}/output/{tkey}/_tmp/step-{p}')
+	if 'trace' in s or s['type'] == 'cg':
+		jobs.append((f'{p}-trace', [f'{tmp}/step-{p}.trace.{i}' for i in split_parts]))
+	jobs.append((p, [f'{tmp}/step-{p}.{i}' for i in split_parts]))
+
+# Start the biggest jobs first, so a large trace doesn't end up running alone at the end
+jobs.sort(key=lambda j: sum(os.path.getsize(f) for f in j[1] if os.path.exists(f)), reverse=True)
+# Forked so the workers inherit the parsed inputs instead of re-running this script
+with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(len(jobs), os.cpu_count())), mp_context=multiprocessing.get_context('fork')) as pool:
+	for f in [pool.submit(split_to_corps, s, fs) for s,fs in jobs]:
+		f.result()
+phase('split')
+
+def update_cache():
+	global steps, parts, cache, fps
+
+	for p,s in steps.items():
+		os.makedirs(f'{cache}/step-{p}/', exist_ok=True)
+		for f,cf in cache_files(p, s):
+			fresh = [f'{tmp}/{f}.{i}' for i in parts if os.path.exists(f'{tmp}/{f}.{i}')]
+			if not fresh:
+				# Everything for this step came from the cache, so just mark it as recently used
+				if os.path.exists(f'{cf}.ids'):
+					os.utime(f'{cf}.ids')
+				continue
+
+			# Fresh results replace older cached ones, while cached results for inputs not in this run are kept
+			ids = set()
+			with open(f'{cf}.txt.new', 'w', encoding='UTF-8') as fd:
+				for fn in fresh:
+					for id,b in Helpers.read_segments(fn):
+						if id in ids:
+							continue
+						ids.add(id)
+						fd.write(b + '\n')
+				if os.path.exists(f'{cf}.txt'):
+					for id,b in Helpers.read_segments(f'{cf}.txt'):
+						if id not in ids:
+							ids.add(id)
+							fd.write(b + '\n')
+			os.replace(f'{cf}.txt.new', f'{cf}.txt')
+			if f == f'step-{p}':
+				Path(f'{cf}.ids').write_text(''.join(f'{id}\n' for id in sorted(ids)), encoding='UTF-8')
+				ts = read_times(f'{cf}.times')
+				ts.update(times[p])
+				Path(f'{cf}.times').write_text(''.join(f'{id}\t{ts[id]:.6f}\n' for id in sorted(ids) if id in ts), encoding='UTF-8')
+
+		# Only keep the most recently used fingerprints
+		fns = sorted(glob.glob(f'{cache}/step-{p}/*.ids'), key=os.path.getmtime, reverse=True)
+		for fn in fns[cache_keep:]:
+			for ext in ['.ids', '.times', '.txt', '.trace.txt', '.streams']:
+				try:
+					os.remove(fn[0:-4] + ext)
+				except FileNotFoundError:
+					pass
+
+if not args.no_cache:
+	update_cache()
+	if streamed:
+		Path(stream_flag).touch()
+	elif buffered and os.path.exists(stream_flag):
+		os.remove(stream_flag)
+phase('cache')
+
+if args.timings:
+	Path(args.timings).write_text(json.dumps(phases, indent=1) + '\n', encoding='UTF-8')
 
 os.remove(f'{root}/output/{tkey}/_tmp/lock')
 print('Done           ')
@@ -11,6 +11,7 @@ let g_state = {
 };
 let state = {};
 let all_corpora = [];
+let g_diffs = {};
 
 // From http://stackoverflow.com/a/41417072/4374566
 $.fn.isInViewport = function() {
@@ -147,7 +148,7 @@ function init() {
 
 function load(p) {
 	let tid = toast('Loading', 'Loading page '+(p+1)+'...');
-	post({n: g_state.nonce, a: 'load', t: g_state.t, c: g_state.c.join(','), g: g_state.g, p: p, z: g_state.z}).done(function(rv) { $(tid).toast('hide'); $('#toasts').text(''); return cb_load(rv); });
+	post({n: g_state.nonce, a: 'load', t: g_state.t, c: g_state.c.join(','), g: g_state.g, p: p, z: g_state.z, d: 1}).done(function(rv) { $(tid).toast('hide'); $('#toasts').text(''); return cb_load(rv); });
 }
 
 function apply_filters() {
@@ -270,8 +271,26 @@ function btn_filter_gold() {
 
 function btn_run() {
 	let c = g_state.c.join(',');
-	let tid = toast('Running Test', 'Launching regression test for: '+(c ? c : '*')+'<br>Check your terminal for progress.');
-	post({n: g_state.nonce, a: 'run', t: g_state.t, c: c}).done(function(rv) { $(tid).toast('hide'); return cb_run(rv); });
+	let tid = toast('Running Test', 'Launching regression test for: '+(c ? c : '*')+'<br><span class="rt-run-progress">Starting</span>');
+	post({n: g_state.nonce, a: 'run', t: g_state.t, c: c}).done(function(rv) { run_events(rv.job, tid); });
+}
+
+function run_events(job, tid) {
+	let es = new EventSource('events?n='+encodeURIComponent(g_state.nonce)+'&j='+job.id);
+	let prog = $(tid).find('.rt-run-progress');
+	es.addEventListener('progress', function(e) {
+		let d = JSON.parse(e.data);
+		prog.text(d.pct+'% ('+d.done+' of '+d.todo+')');
+	});
+	es.addEventListener('steps', function(e) {
+		let d = JSON.parse(e.data);
+		prog.text(Object.entries(d.steps).map(function(s) { return s[0]+' '+s[1]; }).join(', '));
+	});
+	es.addEventListener('done', function(e) {
+		es.close();
+		$(tid).toast('hide');
+		cb_run(JSON.parse(e.data));
+	});
 }
 
 function accept_multiple(hs, s) {
@@ -504,8 +523,11 @@ function btn_show_tab() {
 		// Nothing
 	}
 	else if (expect) {
-		let diff = null;
-		if (occurrences(expect, '\n') >= 100) {
+		let diff = g_diffs[div.attr('id')];
+		if (diff) {
+			// Already diffed by the server
+		}
+		else if (occurrences(expect, '\n') >= 100) {
 			diff = Diff.diffLines(expect, text);
 		}
 		else {
@@ -661,8 +683,30 @@ function cb_init(rv) {
 	load(0);
 }
 
+function expand_entry(e) {
+	// Undoes the server's compact form: changed steps come as diff hunks, repeated outputs as the index of the step with the same output, and expected texts equal to the output as null
+	if (!e.d) {
+		return;
+	}
+	for (let i=0 ; i<e.o.length ; ++i) {
+		if (e.d[i]) {
+			e.o[i] = e.d[i].filter(function(h) { return h[0] !== '-'; }).map(function(h) { return h[1]; }).join('');
+			e.e[i] = e.d[i].filter(function(h) { return h[0] !== '+'; }).map(function(h) { return h[1]; }).join('');
+			g_diffs['t'+e.h+'-'+g_state.test.all_steps[i]] = e.d[i].map(function(h) { return {value: h[1], added: h[0] === '+', removed: h[0] === '-'}; });
+			continue;
+		}
+		if (typeof e.o[i] === 'number') {
+			e.o[i] = e.o[e.o[i]];
+		}
+		if (e.e[i] === null) {
+			e.e[i] = e.o[i];
+		}
+	}
+	delete e.d;
+}
+
 function cb_load(rv) {
-	$('.rt-added,.rt-deleted,.rt-missing,.rt-add-del-warn,.rt-missing-warn').hide();
+	$('.rt-added,.rt-deleted,.rt-missing,.rt-timedout,.rt-add-del-warn,.rt-missing-warn,.rt-timedout-warn').hide();
 	$('#rt-changes').text('');
 
 	let tabs = {};
@@ -670,6 +714,10 @@ function cb_load(rv) {
 	let nd_corps = {};
 
 	state = rv;
+	g_diffs = {};
+	for (let b in state.results) {
+		state.results[b].forEach(expand_entry);
+	}
 	g_state.cs = {};
 	state.corpora.forEach(function(c) { g_state.cs[c] = true; });
 
@@ -737,6 +785,22 @@ function cb_load(rv) {
 		$('.rt-missing,.rt-missing-warn').show();
 	}
 
+	$('#rt-timedout').html('');
+	for (let i=0 ; i<state.results.timedout.length ; ++i) {
+		let e = state.results.timedout[i];
+
+		let cs = [];
+		let lns = [];
+		for (let c in e.c) {
+			lns.push(`${c}:${e.c[c]}`);
+			cs.push(`corp-${c}`);
+		}
+
+		let html = '<tr class="corp '+cs.join(' ')+' hash-'+e.h+'" data-hash="'+e.h+'"><th><tt>'+lns.join('; ')+'</tt></th><td><tt>'+esc_html(e.to)+'</tt></td><td>'+esc_html(to_plain(e.i))+'</td></tr>';
+		$('#rt-timedout').append(html);
+		$('.rt-timedout,.rt-timedout-warn').show();
+	}
+
 	let buckets = {
 		changed_final: '[<span class="text-danger">!</span>] Changed Result',
 		changed_any: '[<span class="text-warning">?</span>] Intermediary Changes',
@@ -952,7 +1016,7 @@ function event_scroll() {
 }
 
 $(function() {
-	$('.rt-added,.rt-deleted,.rt-add-del-warn,.rt-missing,.rt-missing-warn,.rt-filtered-warn,.rt-changes').hide();
+	$('.rt-added,.rt-deleted,.rt-add-del-warn,.rt-missing,.rt-missing-warn,.rt-timedout,.rt-timedout-warn,.rt-filtered-warn,.rt-changes').hide();
 
 	let url = new URL(window.location);
 	g_state.t = get(url.searchParams, 't', '');
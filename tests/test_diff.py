@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Helpers
+
+def lines(n, skip=-1):
+	return ''.join(f'"<w{i}>"\n\t"w{i}" N Sg\n' for i in range(n) if i != skip)
+
+def check(o, e, hunks):
+	assert ''.join(t for op,t in hunks if op != '-') == o
+	assert ''.join(t for op,t in hunks if op != '+') == e
+
+def test_mode_from_expected():
+	# Expected at the line threshold and output just below it must still be split the same way
+	e = lines(50)
+	o = lines(50, skip=20)
+	assert e.count('\n') == 100 and o.count('\n') == 98
+	hunks = Helpers.diff_texts(o, e, 100)
+	check(o, e, hunks)
+	assert [op for op,_ in hunks] == ['=', '-', '=']
+	assert hunks[1][1] == '"<w20>"\n\t"w20" N Sg\n'
+
+def test_mode_output_over_threshold():
+	e = lines(49)
+	o = lines(50)
+	assert e.count('\n') < 100 <= o.count('\n')
+	hunks = Helpers.diff_texts(o, e, 100)
+	check(o, e, hunks)
+	assert [op for op,_ in hunks] == ['=', '+']
+
+def test_words():
+	hunks = Helpers.diff_texts('"<a>"\n\t"a" N Pl\n', '"<a>"\n\t"a" N Sg\n', 100)
+	check('"<a>"\n\t"a" N Pl\n', '"<a>"\n\t"a" N Sg\n', hunks)
+	assert [h for h in hunks if h[0] != '='] == [['-', 'Sg'], ['+', 'Pl']]
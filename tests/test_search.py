@@ -0,0 +1,44 @@
+import os
+import random
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Helpers
+
+def gen_corpus(fname, rnd):
+	words = [''.join(rnd.choice('abfor') for _ in range(rnd.randint(1, 5))) for _ in range(40)] + ['foo', 'fo', 'bar', 'o2', 'f.o']
+	with open(fname, 'w', encoding='UTF-8') as fd:
+		for n in range(300):
+			fd.write(f'<s id="s{n}">\n')
+			for _ in range(rnd.randint(1, 6)):
+				w = rnd.choice(words)
+				fd.write(f'"<{w}>"\n\t"{w.lower()}" N {rnd.choice(["Sg", "Pl"])}\n')
+			fd.write('</s>\n\n')
+
+def gen_pattern(rnd, depth=0):
+	rv = ''
+	for _ in range(rnd.randint(1, 5)):
+		atom = rnd.choice(['f', 'o', 'b', 'a', 'r', 'fo', 'bar', ' ', '.', r'\.', r'\w', r'\s', '[ab]', '[^o]', '"', '<', 'N', 'Sg'])
+		if depth < 2 and rnd.random() < 0.15:
+			atom = '(' + gen_pattern(rnd, depth+1) + ')'
+		rv += atom
+		r = rnd.random()
+		if r < 0.4:
+			rv += rnd.choice(['?', '*', '+', '{2}', '{0}', '{1,2}', '{0,3}', '{2,}', '*?', '+?'])
+	return rv
+
+def test_prefilter_keeps_matches(tmp_path):
+	rnd = random.Random(42)
+	fname = str(tmp_path / 'output.txt')
+	gen_corpus(fname, rnd)
+	segs = Helpers.load_output(fname)
+	terms = Helpers.build_terms(fname)
+
+	pats = ['fo{2}', 'o{2}', 'fo{1,2} bar', 'fo{2}"', '[^]x]oo', r'\bfo{0}o'] + [gen_pattern(rnd) for _ in range(1000)]
+	for p in pats:
+		rx = re.compile(p)
+		want = {id for id,e in segs.items() if rx.search(e['t'])}
+		ns = Helpers.match_terms(terms, Helpers.regex_words(p))
+		got = set(terms['ids']) if ns is None else {terms['ids'][n] for n in ns}
+		assert want <= got, p